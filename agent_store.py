@@ -0,0 +1,350 @@
+from heapq import heapify, heappop, heappush
+import numpy as np
+from functions import EMPTY, moore_neighbors, distinct_neighbors, count_planes
+
+
+class AgentStore:
+    """
+    Struct-of-arrays storage of all agents of a model (torus grid, Moore neighborhood).
+
+    Agents are identified by their index (unique_id) in the parallel arrays cells (flat position x * height + y) and
+    types. Per cell the store keeps the type of the agent on it (grid), the id of that agent (occupant) and the number
+    of neighbors of each type (counts) and in total (totals). These are updated on every relocation, so the
+    neighborhood of a cell can be read without visiting the neighbors.
+    """
+
+    def __init__(self, layout, groups=2):
+        """
+        Create the agents of a layout array (see functions.generate_layout), agent ids follow the grid order.
+
+        Args:
+            layout: uint8 array of shape (width, height) with the type per cell or EMPTY
+            groups: Number of agent types
+        """
+        self.width, self.height = layout.shape
+        self.groups = groups
+
+        self.grid = layout.ravel().copy()
+        self.cells = np.flatnonzero(self.grid != EMPTY)
+        self.types = self.grid[self.cells]
+        self.occupant = np.full(self.grid.size, -1, dtype=np.intp)
+        self.occupant[self.cells] = np.arange(len(self.cells))
+        self.index_empty_cells()
+
+        self.neighbors = moore_neighbors(self.width, self.height)
+        # Only on a torus that is less than 3 cells wide or high the neighbors of a cell repeat, then the entries that
+        # are counted are marked (see functions.distinct_neighbors)
+        self.distinct = None if min(self.width, self.height) >= 3 else distinct_neighbors(self.neighbors)
+        self.counts = count_planes(self.grid, self.neighbors, groups, self.distinct)
+        self.totals = self.counts.sum(axis=0, dtype=np.uint8)
+
+    def restore(self, grid, cells):
+        """
+        Replaces all agents by the agents of a saved state (see snapshot.py) and recomputes the neighbor counts.
+
+        Args:
+            grid: uint8 array with the type per cell (flat) or EMPTY
+            cells: Flat position per agent id
+        """
+        self.grid = grid.copy()
+        self.cells = cells.astype(np.intp)
+        self.types = self.grid[self.cells]
+        self.occupant = np.full(self.grid.size, -1, dtype=np.intp)
+        self.occupant[self.cells] = np.arange(len(self.cells))
+        self.index_empty_cells()
+        self.counts = count_planes(self.grid, self.neighbors, self.groups, self.distinct)
+        self.totals = self.counts.sum(axis=0, dtype=np.uint8)
+
+    def index_empty_cells(self):
+        """
+        Builds the array of the empty cells (flat indices, in no particular order) and per cell its position in that
+        array (-1 for occupied cells), so a random empty cell can be drawn without scanning the grid
+        """
+        self.empty_cells = np.flatnonzero(self.grid == EMPTY)
+        self.empty_index = np.full(self.grid.size, -1, dtype=np.intp)
+        self.empty_index[self.empty_cells] = np.arange(len(self.empty_cells))
+
+    @property
+    def count(self):
+        """Number of agents"""
+        return len(self.cells)
+
+    def type_count(self, agent_type):
+        """Number of agents of the given type"""
+        return int(np.count_nonzero(self.types == agent_type))
+
+    def cell(self, pos):
+        """Flat cell index of an (x, y) position (wraps around the torus)"""
+        return (pos[0] % self.width) * self.height + pos[1] % self.height
+
+    def position(self, cell):
+        """(x, y) position of a flat cell index"""
+        return divmod(int(cell), self.height)
+
+    def neighbor_counts(self, agent_id):
+        """Returns the number of neighbors of the same type and the total number of neighbors of an agent"""
+        cell = self.cells[agent_id]
+        return int(self.counts[self.types[agent_id], cell]), int(self.totals[cell])
+
+    def happy_agents(self, homophily, agent_ids=None):
+        """
+        Whether agents (all agents, or the given ids) are happy: at least a fraction homophily of their neighbors is
+        of their own type. An agent without neighbors is unhappy.
+        """
+        if agent_ids is None:
+            agent_ids = slice(None)
+        cells = self.cells[agent_ids]
+        similar = self.counts[self.types[agent_ids], cells]
+        total_neighbors = self.totals[cells].astype(int)
+        return (total_neighbors != 0) & (similar / np.maximum(total_neighbors, 1) >= homophily)
+
+    def move(self, agent_id, new_cell):
+        """Moves an agent to an empty cell and returns the cell it came from"""
+        old_cell = self.cells[agent_id]
+        agent_type = self.types[agent_id]
+
+        self.grid[old_cell] = EMPTY
+        self.grid[new_cell] = agent_type
+        self.occupant[old_cell] = -1
+        self.occupant[new_cell] = agent_id
+        self.cells[agent_id] = new_cell
+
+        # The old cell takes the place of the new cell in the array of empty cells
+        position = self.empty_index[new_cell]
+        self.empty_cells[position] = old_cell
+        self.empty_index[new_cell] = -1
+        self.empty_index[old_cell] = position
+
+        old_neighbors = self.neighbors[old_cell]
+        new_neighbors = self.neighbors[new_cell]
+        if self.distinct is not None:
+            old_neighbors = old_neighbors[self.distinct[old_cell]]
+            new_neighbors = new_neighbors[self.distinct[new_cell]]
+        self.counts[agent_type, old_neighbors] -= 1
+        self.totals[old_neighbors] -= 1
+        self.counts[agent_type, new_neighbors] += 1
+        self.totals[new_neighbors] += 1
+        return int(old_cell)
+
+    def move_many(self, agent_ids, new_cells):
+        """Moves several agents at once to distinct empty cells (none of them a cell that one of the agents leaves)"""
+        old_cells = self.cells[agent_ids]
+        moved_types = self.types[agent_ids]
+
+        self.grid[old_cells] = EMPTY
+        self.grid[new_cells] = moved_types
+        self.occupant[old_cells] = -1
+        self.occupant[new_cells] = agent_ids
+        self.cells[agent_ids] = new_cells
+
+        positions = self.empty_index[new_cells]
+        self.empty_cells[positions] = old_cells
+        self.empty_index[new_cells] = -1
+        self.empty_index[old_cells] = positions
+
+        old_neighbors = self.neighbors[old_cells]
+        new_neighbors = self.neighbors[new_cells]
+        old_types = new_types = np.broadcast_to(moved_types[:, None], old_neighbors.shape)
+        if self.distinct is not None:
+            old_types, old_neighbors = old_types[self.distinct[old_cells]], old_neighbors[self.distinct[old_cells]]
+            new_types, new_neighbors = new_types[self.distinct[new_cells]], new_neighbors[self.distinct[new_cells]]
+        np.subtract.at(self.counts, (old_types, old_neighbors), 1)
+        np.subtract.at(self.totals, old_neighbors, 1)
+        np.add.at(self.counts, (new_types, new_neighbors), 1)
+        np.add.at(self.totals, new_neighbors, 1)
+
+    def random_empty_cell(self, rng):
+        """Draws a random empty cell with a python random generator (like mesa's move_to_empty)"""
+        if self.count == self.grid.size:
+            raise Exception("ERROR: No empty cells")
+        while True:
+            cell = rng.randrange(self.grid.size)
+            if self.grid[cell] == EMPTY:
+                return cell
+
+    def count_segregated(self):
+        """Number of agents that only have neighbors of their own type"""
+        similar = self.counts[self.types, self.cells]
+        return int(np.count_nonzero(similar == self.totals[self.cells]))
+
+
+class AgentView:
+    """
+    Light-weight mesa-compatible view of one agent of an AgentStore, created on demand (e.g. for the visualisation).
+    """
+
+    __slots__ = ("unique_id", "model")
+
+    def __init__(self, unique_id, model):
+        self.unique_id = unique_id
+        self.model = model
+
+    @property
+    def pos(self):
+        store = self.model.store
+        return store.position(store.cells[self.unique_id])
+
+    @property
+    def type(self):
+        return int(self.model.store.types[self.unique_id])
+
+    def __eq__(self, other):
+        return isinstance(other, AgentView) and (other.model, other.unique_id) == (self.model, self.unique_id)
+
+    def __hash__(self):
+        return hash((id(self.model), self.unique_id))
+
+    def __repr__(self):
+        return f"AgentView(unique_id={self.unique_id}, pos={self.pos}, type={self.type})"
+
+
+class ArraySchedule:
+    """
+    mesa-compatible schedule for the agents of an AgentStore. Every step the agents are activated in a random order
+    (the same order as mesa's RandomActivation) by calling agent_step with the agent id.
+    Without agent_step only the step counters advance.
+    """
+
+    def __init__(self, model, agent_step=None):
+        self.model = model
+        self.agent_step = agent_step
+        self.steps = 0
+        self.time = 0
+
+    def step(self):
+        if self.agent_step is not None:
+            agent_ids = list(range(self.model.store.count))
+            self.model.random.shuffle(agent_ids)
+            for agent_id in agent_ids:
+                self.agent_step(agent_id)
+        self.steps += 1
+        self.time += 1
+
+    def get_agent_count(self):
+        return self.model.store.count
+
+    @property
+    def agents(self):
+        return [AgentView(agent_id, self.model) for agent_id in range(self.model.store.count)]
+
+
+class HappinessSchedule(ArraySchedule):
+    """
+    Random activation in which only the unhappy agents are activated (agent_step is called for an agent that is
+    unhappy when it is its turn). The order and the random numbers are the same as those of ArraySchedule, so the
+    results are the same as activating every agent and letting the happy ones do nothing.
+
+    The happiness of every agent (with the homophily of the model) is kept in self.happy and is only recomputed for
+    the agents around a relocation. After a step, self.unhappy_counts holds the number of agents of each type that
+    were unhappy at their turn, so the model can derive its happiness counters without visiting the happy agents.
+    """
+
+    def __init__(self, model, agent_step):
+        super().__init__(model, agent_step)
+        self.happy = None
+        self.homophily = None
+        self.unhappy_counts = np.zeros(model.store.groups, dtype=int)
+
+    def step(self):
+        store = self.model.store
+        if self.happy is None or self.homophily != self.model.homophily:
+            # At the start, or the homophily was changed, or the agents were replaced (reset)
+            self.homophily = self.model.homophily
+            self.happy = store.happy_agents(self.homophily)
+
+        agent_ids = list(range(store.count))
+        self.model.random.shuffle(agent_ids)
+        rank = np.empty(store.count, dtype=np.intp)
+        rank[agent_ids] = np.arange(store.count)
+
+        # Turns (ranks) of the unhappy agents that did not have their turn yet, in order. An agent that becomes happy
+        # before its turn is skipped when its turn comes up.
+        turns = rank[~self.happy].tolist()
+        heapify(turns)
+        queued = set(turns)
+        unhappy_types = []
+        while turns:
+            turn = heappop(turns)
+            queued.discard(turn)
+            agent_id = agent_ids[turn]
+            if self.happy[agent_id]:
+                continue
+            unhappy_types.append(store.types[agent_id])
+
+            old_cell = store.cells[agent_id]
+            self.agent_step(agent_id)
+            new_cell = store.cells[agent_id]
+            if new_cell == old_cell:
+                continue
+
+            # Only the agents around the old and the new cell (and the agent itself) can change happiness
+            affected = store.occupant[store.neighbors[[old_cell, new_cell]].ravel()]
+            affected = np.append(affected[affected >= 0], agent_id)
+            happy = store.happy_agents(self.homophily, affected)
+            self.happy[affected] = happy
+            for later in rank[affected[~happy & (rank[affected] > turn)]].tolist():
+                if later not in queued:
+                    queued.add(later)
+                    heappush(turns, later)
+
+        self.unhappy_counts = np.bincount(np.array(unhappy_types, dtype=np.intp), minlength=store.groups)
+        self.steps += 1
+        self.time += 1
+
+    def reset(self):
+        """Recompute the happiness of all agents at the next step (e.g. after the agents were replaced)"""
+        self.happy = None
+
+
+class ArrayGrid:
+    """
+    mesa-compatible read-only view of the grid of an AgentStore (SingleGrid on a torus). The cell contents are
+    AgentView objects, created on demand. Agents are moved through the store.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.width = model.store.width
+        self.height = model.store.height
+        self.torus = True
+
+    def agent_at(self, pos):
+        """AgentView of the agent at pos or None for an empty cell"""
+        agent_id = self.model.store.occupant[self.model.store.cell(pos)]
+        return None if agent_id < 0 else AgentView(int(agent_id), self.model)
+
+    def is_cell_empty(self, pos):
+        return self.model.store.grid[self.model.store.cell(pos)] == EMPTY
+
+    @property
+    def empties(self):
+        return {self.model.store.position(cell) for cell in np.flatnonzero(self.model.store.grid == EMPTY)}
+
+    def coord_iter(self):
+        for x in range(self.width):
+            for y in range(self.height):
+                yield self.agent_at((x, y)), (x, y)
+
+    def get_cell_list_contents(self, cell_list):
+        if isinstance(cell_list, tuple) and len(cell_list) == 2:
+            cell_list = [cell_list]
+        agents = (self.agent_at(pos) for pos in cell_list)
+        return [agent for agent in agents if agent is not None]
+
+    def get_neighborhood(self, pos, moore, include_center=False, radius=1):
+        x, y = pos
+        neighborhood = []
+        for dx in range(-radius, radius + 1):
+            for dy in range(-radius, radius + 1):
+                if not moore and abs(dx) + abs(dy) > radius:
+                    continue
+                neighbor = ((x + dx) % self.width, (y + dy) % self.height)
+                if (neighbor != pos or include_center) and neighbor not in neighborhood:
+                    neighborhood.append(neighbor)
+        return neighborhood
+
+    def iter_neighbors(self, pos, moore, include_center=False, radius=1):
+        return iter(self.get_cell_list_contents(self.get_neighborhood(pos, moore, include_center, radius)))
+
+    def get_neighbors(self, pos, moore, include_center=False, radius=1):
+        return self.get_cell_list_contents(self.get_neighborhood(pos, moore, include_center, radius))
@@ -0,0 +1,129 @@
+'''
+Memory-bounded data collection for long runs (e.g. stability studies of millions of steps).
+
+mesa's DataCollector keeps the value of every model variable of every step. The RollingDataCollector only keeps the
+last history_window values of every variable (model_vars holds ring buffers) plus running aggregates of the numeric
+variables over the whole run (number of values, mean, standard deviation, min, max, last value and the last change).
+The full history is only kept when it is requested with a history_file: every collected step is then written to that
+file as a JSON line (read it with pandas.read_json(path, lines=True)).
+
+The models use it with the history_window (and history_file) parameters:
+
+    model = Schelling(homophily=0.4, history_window=1000)
+    while model.running and model.schedule.steps < 1000000:
+        model.step()
+    model.datacollector.summary()
+'''
+import json
+import math
+from collections import deque
+
+import numpy as np
+import pandas as pd
+from mesa.datacollection import DataCollector
+
+AGGREGATES = ("count", "mean", "std", "min", "max", "last", "change")
+
+
+def make_datacollector(model_reporters, history_window=None, history_file=None):
+    '''DataCollector of a model: mesa's DataCollector (full history) without a history_window'''
+    if history_window is None:
+        if history_file is not None:
+            raise ValueError("history_file needs a history_window")
+        return DataCollector(model_reporters)
+    return RollingDataCollector(model_reporters, history_window, history_file)
+
+
+def new_aggregate():
+    '''Running aggregates of a variable before any value (squares is the sum of the squared deviations of the mean)'''
+    return {"count": 0, "mean": 0.0, "squares": 0.0, "min": None, "max": None, "last": None, "change": None}
+
+
+def to_plain(value):
+    '''Converts numpy values in a collected value to plain python values (for the JSON lines of the history file)'''
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Can not write {type(value).__name__} to the history file")
+
+
+class RollingDataCollector(DataCollector):
+    """
+    DataCollector (model reporters only) that keeps the last history_window values of every model variable and
+    running aggregates over all collected steps. With a history_file every collected step is also written to disk.
+    """
+
+    def __init__(self, model_reporters, history_window=1000, history_file=None):
+        if history_window < 1:
+            raise ValueError("history_window must be at least 1")
+        self.history_window = history_window
+        self.collected = 0      # number of collected steps
+        self.aggregates = {}
+        super().__init__(model_reporters)
+
+        self.history_file = history_file
+        self.file = None if history_file is None else open(history_file, "w")
+
+    def _new_model_reporter(self, name, reporter):
+        super()._new_model_reporter(name, reporter)
+        self.model_vars[name] = deque(maxlen=self.history_window)
+        self.aggregates[name] = new_aggregate()
+
+    def collect(self, model):
+        super().collect(model)
+        row = {"Step": self.collected}
+        for name, values in self.model_vars.items():
+            row[name] = values[-1]
+            self.update_aggregate(self.aggregates[name], values[-1])
+        self.collected += 1
+
+        if self.file is not None:
+            self.file.write(json.dumps(row, default=to_plain) + "\n")
+            # The history is written in blocks, the file is flushed once per window
+            if self.collected % self.history_window == 0:
+                self.file.flush()
+
+    @staticmethod
+    def update_aggregate(aggregate, value):
+        '''Adds a value to the running aggregates of a variable (only numbers, other values are skipped)'''
+        if isinstance(value, (bool, np.bool_)):
+            value = int(value)
+        if not isinstance(value, (int, float, np.number)) or math.isnan(value):
+            return
+        value = float(value)
+
+        # Running mean and sum of squared deviations (Welford)
+        aggregate["count"] += 1
+        delta = value - aggregate["mean"]
+        aggregate["mean"] += delta / aggregate["count"]
+        aggregate["squares"] += delta * (value - aggregate["mean"])
+
+        if aggregate["count"] == 1:
+            aggregate["min"] = aggregate["max"] = value
+        else:
+            aggregate["min"] = min(aggregate["min"], value)
+            aggregate["max"] = max(aggregate["max"], value)
+            aggregate["change"] = value - aggregate["last"]
+        aggregate["last"] = value
+
+    def get_model_vars_dataframe(self):
+        """The values of the last history_window steps, indexed by step"""
+        data = pd.DataFrame({name: list(values) for name, values in self.model_vars.items()})
+        data.index = range(self.collected - len(data), self.collected)
+        return data
+
+    def summary(self):
+        """Running aggregates of the numeric model variables over all collected steps (one row per variable)"""
+        rows = {}
+        for name, aggregate in self.aggregates.items():
+            count = aggregate["count"]
+            std = math.sqrt(aggregate["squares"] / count) if count else None
+            rows[name] = {**{key: aggregate[key] for key in AGGREGATES if key != "std"}, "std": std}
+        return pd.DataFrame.from_dict(rows, orient="index", columns=list(AGGREGATES))
+
+    def close(self):
+        """Closes the history file"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
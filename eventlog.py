@@ -0,0 +1,105 @@
+'''
+Binary log of the relocations of the agents (models 2, 3a and 3b with an event_log file), for flow analyses.
+
+Every relocation is one fixed-size record (EVENT_DTYPE): the step (the index of the DataCollector row of that step, so
+the first step is 1), the agent id, the flat cell it came from, the flat cell it moved to (x * height + y) and the type
+of the agent. The records are collected in a buffer of fixed size, which is written to the file when it is full and
+at the end of every step. The file starts with a header with the size of the grid and the number of agents.
+
+    model = Schelling(homophily=0.5, event_log="results/moves.log")
+    ...
+    events, header = read_event_log("results/moves.log")
+    moves = move_counts(events, header["agents"])
+    flows = flow_matrix(events, header["width"], header["height"])
+'''
+import os
+
+import numpy as np
+from metrics import BLOCK_SIZE
+
+MAGIC = b"SCHLOG01"
+
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("width", "<u4"), ("height", "<u4"), ("agents", "<u4")])
+
+EVENT_DTYPE = np.dtype([("step", "<u4"), ("agent", "<u4"), ("from_cell", "<u4"), ("to_cell", "<u4"), ("type", "u1")])
+
+# Number of records that are kept in memory before they are written to the file
+EVENT_BUFFER_SIZE = 65536
+
+
+class EventLog:
+    """
+    Writer of the relocation log of a model. The file is created (or overwritten) when the log is created.
+    """
+
+    def __init__(self, path, width, height, agents, buffer_size=EVENT_BUFFER_SIZE):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(np.array([(MAGIC, width, height, agents)], dtype=HEADER_DTYPE).tobytes())
+        self.buffer = np.empty(buffer_size, dtype=EVENT_DTYPE)
+        self.size = 0
+
+    def record(self, step, agent_id, from_cell, to_cell, agent_type):
+        """Adds one relocation to the buffer, the buffer is written to the file when it is full"""
+        self.buffer[self.size] = (step, agent_id, from_cell, to_cell, agent_type)
+        self.size += 1
+        if self.size == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered relocations to the file"""
+        if self.size:
+            self.file.write(self.buffer[:self.size].tobytes())
+            self.size = 0
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_event_log(path):
+    '''
+    Reads a relocation log. Returns the records (a read-only structured array with the fields of EVENT_DTYPE,
+    mapped from the file so large logs are only read when used) and the header as a dict (width, height, agents)
+    '''
+    header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)
+    if len(header) == 0 or header["magic"][0] != MAGIC:
+        raise ValueError(f"{path} is not a relocation log")
+    header = {name: int(header[name][0]) for name in ("width", "height", "agents")}
+
+    # An empty log can not be mapped
+    count = (os.path.getsize(path) - HEADER_DTYPE.itemsize) // EVENT_DTYPE.itemsize
+    if count == 0:
+        return np.empty(0, dtype=EVENT_DTYPE), header
+    events = np.memmap(path, dtype=EVENT_DTYPE, mode="r", offset=HEADER_DTYPE.itemsize, shape=(count,))
+    return events, header
+
+
+def move_counts(events, agents=None):
+    '''Number of relocations per agent id'''
+    return np.bincount(events["agent"], minlength=agents or 0)
+
+
+def moves_per_step(events):
+    '''Number of relocations per step (index 0 is the initial state, without relocations)'''
+    return np.bincount(events["step"])
+
+
+def flow_matrix(events, width, height, block=BLOCK_SIZE, agent_type=None):
+    '''
+    Number of relocations between areal units (square blocks of block x block cells, numbered like in
+    metrics.unit_counts). Returns a units x units matrix in which [a, b] is the number of moves from unit a to unit b.
+    With agent_type only the relocations of that type are counted.
+    '''
+    if agent_type is not None:
+        events = events[events["type"] == agent_type]
+    units_y = -(-height // block)
+    units = -(-width // block) * units_y
+
+    def unit(cells):
+        x, y = np.divmod(cells.astype(np.int64), height)
+        return (x // block) * units_y + (y // block)
+
+    flows = np.bincount(unit(events["from_cell"]) * units + unit(events["to_cell"]), minlength=units * units)
+    return flows.reshape(units, units)
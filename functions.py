@@ -1,3 +1,11 @@
+from bisect import bisect_left
+
+import numpy as np
+
+# Value of an empty cell in a layout (type) array
+EMPTY = 255
+
+
 def get_neighbors_snake(x,y,grid):
     '''Alternative function to the grid.get_neighborhood function of mesa.
     This functions looks for the neighbors in the surrouding cells but it follows snake/circle path (Instead of going bottom to up per column)
@@ -57,4 +65,95 @@ def get_neighbors_snake(x,y,grid):
     else:
         neighbor_list.append(None)
 
-    return neighbor_list
\ No newline at end of file
+    return neighbor_list
+
+
+def update_sorted_pool(pool, cell, qualifies):
+    '''Adds or removes a cell from a list of potential locations that is kept sorted in grid (coord_iter) order.
+    Keeping the list in this order gives the same list as a full scan over the grid, so random.choice picks the same cells'''
+    i = bisect_left(pool, cell)
+    present = i < len(pool) and pool[i] == cell
+
+    if qualifies and not present:
+        pool.insert(i, cell)
+    elif not qualifies and present:
+        del pool[i]
+
+
+# Number of cells that are sampled in a step before the acceptance rate is checked for the first time
+LAZY_WARMUP_SAMPLES = 20
+
+
+def sample_destination(model, agent_type):
+    '''Lazy alternative to picking from the precomputed lists of potential locations (rejection sampling).
+    Random empty cells (flat indices, drawn from the empty cell array of the agent store) are tested with
+    model.classify_cell until one is a correct location for the agent type.
+    Returns None when the acceptance rate of the current step falls below model.min_acceptance_rate (or there are no
+    empty cells), the model should then fall back to its precomputed lists'''
+    empty_cells = model.store.empty_cells
+    if len(empty_cells) == 0:
+        return None
+    while True:
+        cell = int(empty_cells[model.random.randrange(len(empty_cells))])
+        model.lazy_samples += 1
+
+        blue_correct, red_correct = model.classify_cell(cell)
+        if (blue_correct if agent_type == 1 else red_correct):
+            model.lazy_accepted += 1
+            return cell
+
+        if model.lazy_samples >= LAZY_WARMUP_SAMPLES and (
+                model.lazy_accepted < model.min_acceptance_rate * model.lazy_samples):
+            return None
+
+
+def generate_layout(width, height, density, minority_pc, rng):
+    '''Generates the initial population of the grid in bulk from a numpy random generator.
+    Every cell is occupied with probability density and every agent is a blue (minority) agent with probability
+    minority_pc, just like drawing the cells one by one.
+    Returns a uint8 array of shape (width, height) with 1 for blue agents, 0 for red agents and EMPTY for empty cells'''
+    occupied = rng.random((width, height)) < density
+    blue = rng.random((width, height)) < minority_pc
+    return np.where(occupied, blue, EMPTY).astype(np.uint8)
+
+
+def generate_group_layout(width, height, density, group_pcs, rng):
+    '''Generates an initial population with any number of groups (K-group version of generate_layout).
+    Every cell is occupied with probability density and an agent belongs to group k with probability group_pcs[k].
+    Returns a uint8 array of shape (width, height) with the group number of the agent or EMPTY for empty cells'''
+    group_pcs = np.asarray(group_pcs, dtype=float)
+    occupied = rng.random((width, height)) < density
+    groups = rng.choice(len(group_pcs), size=(width, height), p=group_pcs / group_pcs.sum())
+    return np.where(occupied, groups, EMPTY).astype(np.uint8)
+
+
+def moore_neighbors(width, height):
+    '''Flat indices (x * height + y, the coord_iter order) of the 8 surrounding cells of every cell of a torus grid.
+    Returns an array of shape (width * height, 8)'''
+    x, y = np.divmod(np.arange(width * height), height)
+    offsets = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if (dx, dy) != (0, 0)]
+    return np.stack([((x + dx) % width) * height + (y + dy) % height for dx, dy in offsets], axis=1)
+
+
+def distinct_neighbors(neighbors):
+    '''Marks the entries of a moore_neighbors table that are distinct neighbors of the cell. On a torus that is less
+    than 3 cells wide or high the 8 surrounding cells repeat (or include the cell itself), like mesa's get_neighborhood
+    every neighbor is only counted once and a cell is not its own neighbor.
+    Returns a boolean array of the shape of neighbors'''
+    distinct = neighbors != np.arange(len(neighbors))[:, None]
+    for column in range(1, neighbors.shape[1]):
+        distinct[:, column] &= (neighbors[:, :column] != neighbors[:, column, None]).all(axis=1)
+    return distinct
+
+
+def count_planes(types, neighbors, groups, distinct=None):
+    '''Counts for every cell how many of its neighbors belong to each group.
+    types is the flat uint8 type array, distinct optionally marks the entries of neighbors that are counted (see
+    distinct_neighbors). Returns a uint8 array of shape (groups, number of cells)'''
+    neighbor_types = types[neighbors]
+    if distinct is not None:
+        neighbor_types = np.where(distinct, neighbor_types, EMPTY)
+    counts = np.empty((groups, types.size), dtype=np.uint8)
+    for group in range(groups):
+        counts[group] = np.count_nonzero(neighbor_types == group, axis=1)
+    return counts
@@ -0,0 +1,431 @@
+'''
+Local job service, so several people can share one machine for their simulations. Runs and sweeps of the models are
+submitted over HTTP, queued on one pool of worker processes and their progress is streamed back.
+
+    python jobs.py --port 8600 --workers 8
+
+Endpoints (JSON):
+
+    POST   /jobs                 submit a job, returns the job status (with its id)
+    GET    /jobs                 status of all jobs (?owner=<name> for the jobs of one person)
+    GET    /jobs/<id>            status of one job
+    GET    /jobs/<id>/events     progress of a job as JSON lines, from the start of the job until it is finished
+    GET    /jobs/<id>/results    rows (see sweep.py) of the runs that finished so far
+    DELETE /jobs/<id>            cancel the runs of a job that did not start yet
+
+A job is a sweep config (see sweep.py) plus an optional owner and progress_interval (the number of steps between
+progress events of a run, 0 for only an event per finished run). A single run is a job without lists in the parameters:
+
+    curl -X POST localhost:8600/jobs -d '{"model": "model2", "parameters": {"homophily": 0.3}, "max_steps": 200}'
+    curl -N localhost:8600/jobs/1/events
+
+The workers setting of a config is not used, all jobs share the workers of the service. The free workers take turns
+between the jobs with runs left, so a large sweep does not block the jobs that are submitted after it. Output files
+are only written when the job has an output in its config. Jobs can only write to and read from the directories of the
+service: the output is a path in the results directory (--results-directory) and the snapshot a path in the snapshot
+directory (--snapshot-directory, without it jobs can not use snapshots, they are pickled files). The model parameters
+that write files (event_log and history_file) can not be set in a job.
+
+Events are {"event": ..., "job": <id>, ...} with event one of: queued, started, step (RunId, Step and the model
+variables), run (the row of a finished run), error (RunId and the error of a failed run) and finished (status done,
+cancelled or failed).
+'''
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import tornado.iostream
+import tornado.web
+
+from results import summarize, summary_path, write_table
+from sweep import apply_defaults, enumerate_runs, run_model
+
+MODELS = ("model1", "model2", "model3a", "model3b", "modelk")
+
+# Steps between the progress events of a run when the job does not set progress_interval
+PROGRESS_INTERVAL = 10
+
+# Settings of a job that must be non-negative integers
+COUNT_SETTINGS = ("iterations", "max_steps", "progress_interval")
+
+# Model parameters that write files, these can not be set in a job
+FILE_PARAMETERS = ("event_log", "history_file")
+
+
+def to_plain(value):
+    '''Converts numpy values and NaN (not valid JSON) in events and rows to plain JSON values'''
+    if isinstance(value, dict):
+        return {str(key): to_plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [to_plain(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def service_path(path, directory, setting):
+    '''
+    Resolves a path of a job relative to a directory of the service. Paths outside the directory (absolute paths,
+    .. or symbolic links that lead outside it) are not allowed.
+    '''
+    if not isinstance(path, str) or not path:
+        raise ValueError(f"The {setting} of a job must be a path")
+    directory = os.path.realpath(directory)
+    resolved = os.path.realpath(os.path.join(directory, path))
+    if resolved == directory or os.path.commonpath([directory, resolved]) != directory:
+        raise ValueError(f"The {setting} of a job must be a file in {directory}")
+    return resolved
+
+
+def job_config(request, results_directory="results", snapshot_directory=None):
+    '''
+    Checks a submitted job and fills in the defaults of the sweep config. The output is placed in the results
+    directory and the snapshot must be in the snapshot directory (without a snapshot directory snapshots are refused).
+    '''
+    if not isinstance(request, dict):
+        raise ValueError("A job must be a JSON object")
+    if request.get("model") not in MODELS:
+        raise ValueError(f"Unknown model '{request.get('model')}', choose from {', '.join(MODELS)}")
+    if not isinstance(request.get("parameters", {}), dict):
+        raise ValueError("The parameters of a job must be a JSON object")
+    for name in FILE_PARAMETERS:
+        if request.get("parameters", {}).get(name) not in (None, [None]):
+            raise ValueError(f"Parameter '{name}' writes a file and can not be set in a job")
+
+    config = dict(request, output=request.get("output"))
+    config.setdefault("parameters", {})
+    config.setdefault("owner", None)
+    config.setdefault("progress_interval", PROGRESS_INTERVAL)
+    apply_defaults(config)
+
+    for name in COUNT_SETTINGS:
+        value = config[name]
+        if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+            raise ValueError(f"{name} must be a non-negative integer")
+    if config["seed"] is not None and (isinstance(config["seed"], bool) or not isinstance(config["seed"], int)):
+        raise ValueError("seed must be an integer")
+
+    if config["output"] is not None:
+        config["output"] = service_path(config["output"], results_directory, "output")
+    if config["snapshot"] is not None:
+        if snapshot_directory is None:
+            raise ValueError("This service does not accept snapshots (it has no snapshot directory)")
+        config["snapshot"] = service_path(config["snapshot"], snapshot_directory, "snapshot")
+        if not os.path.isfile(config["snapshot"]):
+            raise ValueError(f"Unknown snapshot '{request['snapshot']}'")
+    if config["step_data"] and config["output"] is None:
+        raise ValueError("step_data needs an output")
+    return config
+
+
+class ProgressQueue:
+    '''Queue on which the runs of one job put their progress (picklable, so it can be sent to the workers)'''
+
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.job_id = job_id
+
+    def put(self, item):
+        self.queue.put((self.job_id, item))
+
+
+class Job:
+    '''A submitted run or sweep: its runs that still have to start, the finished rows and all events so far'''
+
+    def __init__(self, job_id, config):
+        self.id = job_id
+        self.config = config
+        self.runs = enumerate_runs(config)
+        self.pending = deque(self.runs)
+        self.active = 0
+        self.rows = []
+        self.errors = []
+        self.events = []
+        self.status = "queued"
+        self.closed = False
+        self.submitted = time.time()
+        self.updated = asyncio.Event()
+        self.publish("queued", runs=len(self.runs))
+
+    @property
+    def finished(self):
+        '''Whether the job is finished (done, cancelled or failed) and all its events are published'''
+        return self.closed
+
+    def publish(self, event, **data):
+        '''Adds an event and wakes up the streams that wait for it'''
+        self.events.append(to_plain({"event": event, "job": self.id, **data}))
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+    async def wait_for_events(self, seen):
+        '''Waits until there are more than seen events or the job is finished'''
+        if len(self.events) == seen and not self.finished:
+            await self.updated.wait()
+
+    def info(self):
+        return {"id": self.id, "model": self.config["model"], "owner": self.config["owner"], "status": self.status,
+                "runs": len(self.runs), "finished_runs": len(self.rows), "failed_runs": len(self.errors),
+                "submitted": self.submitted}
+
+
+class JobService:
+    '''
+    Queue of the jobs and the pool of worker processes. Every free worker starts the next run of the next job with runs
+    left (round robin). The progress of the runs comes back on one queue of a multiprocessing manager.
+    '''
+
+    def __init__(self, workers=None, results_directory="results", snapshot_directory=None):
+        self.workers = workers or os.cpu_count()
+        self.results_directory = results_directory
+        self.snapshot_directory = snapshot_directory
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        self.manager = multiprocessing.Manager()
+        self.progress = self.manager.Queue()
+        self.slots = asyncio.Semaphore(self.workers)
+        self.work = asyncio.Event()
+        self.waiting = deque()
+        self.flushes = {}       # futures of flush_progress by token
+        self.jobs = {}
+        self.next_id = 1
+        self.tasks = []
+
+    def start(self):
+        '''Starts dispatching runs and forwarding progress (in the running event loop)'''
+        self.tasks = [asyncio.ensure_future(self.dispatch()), asyncio.ensure_future(self.forward_progress())]
+
+    def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+        self.pool.shutdown(cancel_futures=True)
+        self.manager.shutdown()
+
+    def submit(self, request):
+        '''Adds a job to the queue and returns it'''
+        job = Job(self.next_id, job_config(request, self.results_directory, self.snapshot_directory))
+        self.jobs[job.id] = job
+        self.next_id += 1
+        if job.pending:
+            self.waiting.append(job)
+            self.work.set()
+        else:
+            asyncio.ensure_future(self.finish(job))
+        return job
+
+    def cancel(self, job):
+        '''Cancels the runs of a job that did not start yet, the running runs are finished'''
+        if job.finished or job.status == "cancelled":
+            return
+        job.pending.clear()
+        if job in self.waiting:
+            self.waiting.remove(job)
+        job.status = "cancelled"
+        if job.active == 0:
+            asyncio.ensure_future(self.finish(job))
+
+    async def next_run(self):
+        '''Waits for a job with runs left and takes its next run, the job goes to the back of the queue'''
+        while not self.waiting:
+            self.work.clear()
+            await self.work.wait()
+        job = self.waiting.popleft()
+        run = job.pending.popleft()
+        if job.pending:
+            self.waiting.append(job)
+        return job, run
+
+    async def dispatch(self):
+        while True:
+            await self.slots.acquire()
+            job, run = await self.next_run()
+            job.active += 1
+            asyncio.ensure_future(self.execute(job, run))
+
+    async def execute(self, job, run):
+        '''Runs one run of a job on the pool and publishes its row'''
+        config = job.config
+        if job.status == "queued":
+            job.status = "running"
+            job.publish("started")
+
+        progress = ProgressQueue(self.progress, job.id) if config["progress_interval"] else None
+        try:
+            row = await asyncio.get_running_loop().run_in_executor(
+                self.pool, partial(run_model, run, config["model"], config["max_steps"], config["seed"],
+                                   step_output=config["output"] if config["step_data"] else None,
+                                   output_format=config["format"], progress=progress,
+                                   progress_interval=config["progress_interval"], snapshot=config["snapshot"]))
+        except Exception as error:
+            row = None
+            job.errors.append({"RunId": run[0], "error": repr(error)})
+        finally:
+            self.slots.release()
+
+        # The step events of the run come first
+        if progress is not None:
+            await self.flush_progress()
+        if row is None:
+            job.publish("error", **job.errors[-1])
+        else:
+            job.rows.append(row)
+            job.publish("run", **row)
+        job.active -= 1
+
+        if job.active == 0 and not job.pending:
+            await self.finish(job)
+
+    async def forward_progress(self):
+        '''Publishes the progress the runs put on the queue as step events of their job'''
+        loop = asyncio.get_running_loop()
+        while True:
+            job_id, item = await loop.run_in_executor(None, self.progress.get)
+            if job_id is None:
+                self.flushes.pop(item).set_result(None)
+            else:
+                self.jobs[job_id].publish("step", **item)
+
+    async def flush_progress(self):
+        '''Waits until all progress that is on the queue now has been published'''
+        loop = asyncio.get_running_loop()
+        flushed = loop.create_future()
+        token = id(flushed)
+        self.flushes[token] = flushed
+        await loop.run_in_executor(None, self.progress.put, (None, token))
+        await flushed
+
+    async def finish(self, job):
+        '''Writes the output of a job (when configured) and publishes that it is finished'''
+        job.rows.sort(key=lambda row: row["RunId"])
+
+        config = job.config
+        if config["output"] is not None and job.rows:
+            data = pd.DataFrame(job.rows)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, write_table, data, config["output"], config["format"])
+            if len(job.rows) == len(job.runs):
+                summary = summarize(data, config["parameters"])
+                await loop.run_in_executor(None, write_table, summary, summary_path(config["output"]), config["format"])
+
+        if job.status != "cancelled":
+            job.status = "failed" if job.errors else "done"
+        job.publish("finished", status=job.status)
+        job.closed = True
+
+
+class JobHandler(tornado.web.RequestHandler):
+
+    def initialize(self, service):
+        self.service = service
+
+    def get_job(self, job_id):
+        job = self.service.jobs.get(int(job_id))
+        if job is None:
+            raise tornado.web.HTTPError(404, reason=f"Unknown job {job_id}")
+        return job
+
+    def write_json(self, data):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(to_plain(data)))
+
+
+class JobsHandler(JobHandler):
+
+    def get(self):
+        owner = self.get_query_argument("owner", None)
+        jobs = [job.info() for job in self.service.jobs.values() if owner is None or job.config["owner"] == owner]
+        self.write_json(jobs)
+
+    def post(self):
+        try:
+            job = self.service.submit(json.loads(self.request.body or b"null"))
+        except ValueError as error:
+            self.set_status(400)
+            self.write_json({"error": str(error)})
+            return
+        self.set_status(201)
+        self.write_json(job.info())
+
+
+class JobStatusHandler(JobHandler):
+
+    def get(self, job_id):
+        self.write_json(self.get_job(job_id).info())
+
+    def delete(self, job_id):
+        job = self.get_job(job_id)
+        self.service.cancel(job)
+        self.write_json(job.info())
+
+
+class JobEventsHandler(JobHandler):
+
+    async def get(self, job_id):
+        job = self.get_job(job_id)
+        self.set_header("Content-Type", "application/x-ndjson")
+        seen = 0
+        try:
+            while True:
+                for event in job.events[seen:]:
+                    self.write(json.dumps(event) + "\n")
+                seen = len(job.events)
+                await self.flush()
+                if job.finished and seen == len(job.events):
+                    break
+                await job.wait_for_events(seen)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+
+class JobResultsHandler(JobHandler):
+
+    def get(self, job_id):
+        job = self.get_job(job_id)
+        self.write_json({**job.info(), "rows": sorted(job.rows, key=lambda row: row["RunId"]), "errors": job.errors})
+
+
+def make_app(service):
+    arguments = {"service": service}
+    return tornado.web.Application([
+        (r"/jobs", JobsHandler, arguments),
+        (r"/jobs/(\d+)", JobStatusHandler, arguments),
+        (r"/jobs/(\d+)/events", JobEventsHandler, arguments),
+        (r"/jobs/(\d+)/results", JobResultsHandler, arguments),
+    ])
+
+
+async def serve(port, address, workers, results_directory, snapshot_directory):
+    service = JobService(workers, results_directory, snapshot_directory)
+    service.start()
+    make_app(service).listen(port, address)
+    print(f"Job service with {service.workers} workers on http://{address}:{port}/jobs")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        service.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local job service for runs and sweeps of the Schelling models")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--address", default="127.0.0.1", help="address to listen on (default: only this machine)")
+    parser.add_argument("--workers", type=int, help="number of worker processes (default: all cpus)")
+    parser.add_argument("--results-directory", default="results",
+                        help="directory in which the outputs of the jobs are written (default: results)")
+    parser.add_argument("--snapshot-directory",
+                        help="directory with the snapshots the jobs may start from (default: no snapshots)")
+    args = parser.parse_args(argv)
+    asyncio.run(serve(args.port, args.address, args.workers, args.results_directory, args.snapshot_directory))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import numpy as np
+from functions import EMPTY
+
+# Size (in cells) of the square areal units used by the dissimilarity and exposure indices
+BLOCK_SIZE = 5
+
+# Half of the Moore neighborhood, every pair of neighboring cells is visited once with these offsets
+HALF_MOORE_OFFSETS = [(1, 0), (0, 1), (1, 1), (1, -1)]
+
+
+def type_array(model):
+    '''Returns the uint8 type array of shape (width, height) of a model (group per cell, EMPTY for empty cells).
+    Models with an AgentStore return the array of the store, for other mesa models it is built from the agents'''
+    if hasattr(model, 'store'):
+        return model.store.grid.reshape(model.store.width, model.store.height)
+
+    types = np.full((model.grid.width, model.grid.height), EMPTY, dtype=np.uint8)
+    for agent in model.schedule.agents:
+        types[agent.pos] = agent.type
+    return types
+
+
+def number_of_groups(types):
+    '''Number of groups in a type array (at least the two groups of the original models)'''
+    occupied = types[types != EMPTY]
+    return max(2, int(occupied.max()) + 1 if occupied.size else 0)
+
+
+def unit_counts(types, block=BLOCK_SIZE, groups=None):
+    '''Counts the agents of each group per areal unit (square blocks of block x block cells).
+    Returns an array of shape (number of units, groups)'''
+    groups = groups or number_of_groups(types)
+    width, height = types.shape
+    units_y = -(-height // block)
+    x, y = np.nonzero(types != EMPTY)
+    unit = (x // block) * units_y + (y // block)
+    units = -(-width // block) * units_y
+    counts = np.bincount(unit * groups + types[x, y], minlength=units * groups)
+    return counts.reshape(units, groups)
+
+
+def dissimilarity_index(types, block=BLOCK_SIZE, groups=None):
+    '''
+    Dissimilarity index D over areal units. For two groups this is 0.5 * sum |a_i / A - b_i / B|, for more groups the
+    multigroup version (Reardon & Firebaugh) is used. 0 means every unit has the composition of the whole grid,
+    1 means complete segregation.
+    '''
+    counts = unit_counts(types, block, groups)
+    unit_totals = counts.sum(axis=1)
+    total = unit_totals.sum()
+    if total == 0:
+        return 0.0
+
+    proportions = counts.sum(axis=0) / total
+    interaction = np.sum(proportions * (1 - proportions))
+    if interaction == 0:
+        return 0.0
+
+    unit_proportions = counts / np.maximum(unit_totals, 1)[:, None]
+    deviation = np.sum(unit_totals[:, None] * np.abs(unit_proportions - proportions))
+    return float(deviation / (2 * total * interaction))
+
+
+def exposure_index(types, block=BLOCK_SIZE, groups=None):
+    '''
+    Exposure index over areal units. Returns a groups x groups matrix in which [a, b] is the average share of group b
+    in the unit of a member of group a. The diagonal is the isolation index of each group.
+    '''
+    counts = unit_counts(types, block, groups)
+    unit_totals = np.maximum(counts.sum(axis=1), 1)
+    group_totals = np.maximum(counts.sum(axis=0), 1)
+    return (counts / group_totals).T @ (counts / unit_totals[:, None])
+
+
+def isolation_index(types, block=BLOCK_SIZE, groups=None):
+    '''Isolation index per group (the diagonal of the exposure matrix)'''
+    return np.diag(exposure_index(types, block, groups)).copy()
+
+
+def neighbor_sum(values):
+    '''Sum of the values of the 8 surrounding cells of every cell of a torus grid'''
+    total = np.zeros_like(values)
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            if (dx, dy) != (0, 0):
+                total += np.roll(values, (dx, dy), axis=(0, 1))
+    return total
+
+
+def morans_i(types, group=None):
+    '''
+    Moran's I of the membership of a group among the agents, with equal weights for the 8 surrounding cells (torus).
+    Positive values mean agents of the group cluster together. Without a group, a list with the value per group.
+    '''
+    if group is None:
+        return [morans_i(types, group) for group in range(number_of_groups(types))]
+
+    occupied = types != EMPTY
+    n = np.count_nonzero(occupied)
+    if n == 0:
+        return 0.0
+
+    member = (types == group).astype(float)
+    deviation = np.where(occupied, member - member[occupied].mean(), 0.0)
+    variance = np.sum(deviation ** 2)
+    weights = np.sum(neighbor_sum(occupied.astype(float))[occupied])
+    if variance == 0 or weights == 0:
+        return 0.0
+    return float(n / weights * np.sum(deviation * neighbor_sum(deviation)) / variance)
+
+
+def label_clusters(types):
+    '''
+    Connected-component labelling of the agents: neighboring agents (Moore neighborhood, torus) of the same group
+    belong to the same cluster. Returns a flat array with per cell the cluster label (the smallest flat index in the
+    cluster), empty cells keep their own index.
+    '''
+    width, height = types.shape
+    flat = types.ravel()
+    cells = np.arange(flat.size)
+    x, y = np.divmod(cells, height)
+
+    # All pairs of neighboring agents of the same group
+    sources = []
+    targets = []
+    for dx, dy in HALF_MOORE_OFFSETS:
+        neighbor = ((x + dx) % width) * height + (y + dy) % height
+        same = (flat != EMPTY) & (flat[neighbor] == flat)
+        sources.append(cells[same])
+        targets.append(neighbor[same])
+    sources = np.concatenate(sources)
+    targets = np.concatenate(targets)
+
+    # Hook the larger label onto the smaller one along every pair, then shorten the label chains (pointer jumping)
+    # until both cells of every pair have the same label
+    labels = cells.copy()
+    while True:
+        source_labels = labels[sources]
+        target_labels = labels[targets]
+        if np.array_equal(source_labels, target_labels):
+            return labels
+        np.minimum.at(labels, np.maximum(source_labels, target_labels), np.minimum(source_labels, target_labels))
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+
+def cluster_sizes(types):
+    '''
+    Sizes of all clusters of same-group agents (see label_clusters).
+    Returns two arrays: the group of every cluster and its size
+    '''
+    labels = label_clusters(types)
+    flat = types.ravel()
+    roots, sizes = np.unique(labels[flat != EMPTY], return_counts=True)
+    return flat[roots], sizes
+
+
+def cluster_size_distribution(types):
+    '''Number of clusters per cluster size ({size: number of clusters})'''
+    sizes, frequency = np.unique(cluster_sizes(types)[1], return_counts=True)
+    return dict(zip(sizes.tolist(), frequency.tolist()))
+
+
+def mean_cluster_size(types):
+    '''Average size of the cluster an agent belongs to (larger when agents live in bigger same-group areas)'''
+    sizes = cluster_sizes(types)[1]
+    if sizes.size == 0:
+        return 0.0
+    return float(np.sum(sizes ** 2) / np.sum(sizes))
+
+
+# Metrics that can be selected for the DataCollector of a model
+METRICS = {
+    "dissimilarity_index": dissimilarity_index,
+    "exposure_index": lambda types: exposure_index(types).tolist(),
+    "isolation_index": lambda types: isolation_index(types).tolist(),
+    "morans_i": morans_i,
+    "cluster_size_distribution": cluster_size_distribution,
+    "mean_cluster_size": mean_cluster_size,
+}
+
+
+def metric_reporters(metrics=(), interval=1):
+    '''
+    Creates model reporters for the DataCollector for the selected metrics (names in METRICS).
+    The metrics are only computed every interval steps, on the other steps the reporters return None.
+    '''
+    reporters = {}
+    for name in metrics:
+        if name not in METRICS:
+            raise ValueError(f"Unknown metric '{name}', choose from {', '.join(METRICS)}")
+        reporters[name] = sampled_reporter(METRICS[name], interval)
+    return reporters
+
+
+def sampled_reporter(metric, interval):
+    '''Model reporter that computes the metric on the type array of the model every interval steps'''
+    def reporter(model):
+        if model.schedule.steps % interval != 0:
+            return None
+        return metric(type_array(model))
+    return reporter
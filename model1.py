@@ -1,58 +1,24 @@
-from mesa import Model, Agent
-from mesa.time import RandomActivation
-from mesa.space import SingleGrid
-from mesa.datacollection import DataCollector
+from mesa import Model
+from collector import make_datacollector
 from random import random
-
-
-class SchellingAgent(Agent):
-    """
-    Schelling segregation agent
-    """
-
-    def __init__(self, pos, model, agent_type):
-        """
-        Create a new Schelling agent.
-
-        Args:
-           unique_id: Unique identifier for the agent.
-           x, y: Agent initial location.
-           agent_type: Indicator for the agent's type (minority=1 (blue), majority=0 (red))
-        """
-        super().__init__(pos, model)
-        self.pos = pos
-        self.type = agent_type
-
-    def step(self):
-        similar = 0
-        total_neighbors = 0
-        for neighbor in self.model.grid.iter_neighbors(self.pos, moore=True,
-                                                       radius=1):  # Adjust vision here to Moore (square neighborhood) and radius size
-            total_neighbors += 1
-            if neighbor.type == self.type:
-                similar += 1
-
-        # If unhappy, move to a location within their socioeconomic limits
-        if total_neighbors == 0 or (
-                (similar / total_neighbors) < self.model.homophily):  # Using percentages (instead of absolute number)
-            self.model.grid.move_to_empty(self)
-
-
-        # Otherwise count agent as happy
-        else:
-            self.model.happy += 1
-            if self.type == 1:
-                self.model.happy_blue_agents_count += 1
-            else:
-                self.model.happy_red_agents_count += 1
+import numpy as np
+from metrics import metric_reporters
+from functions import generate_layout
+from agent_store import AgentStore, HappinessSchedule, ArrayGrid
 
 
 class Schelling(Model):
     """
     Model class for the Schelling segregation model.
+
+    The agents are stored as arrays in an AgentStore, self.schedule and self.grid are mesa-compatible views on it.
     """
 
-    def __init__(self, height=20, width=20, density=0.8, minority_pc=0.2, homophily=3):
+    def __init__(self, height=20, width=20, density=0.8, minority_pc=0.2, homophily=3, seed=None, metrics=(), metrics_interval=1, history_window=None, history_file=None):
+
+        # Constructor arguments, used to fork the model from a snapshot with changed parameters (see snapshot.py)
+        self.parameters = dict(locals())
+        del self.parameters["self"]
 
         self.total_satisfaction_index = 0
         self.blue_satisfaction_index = 0
@@ -68,37 +34,32 @@ class Schelling(Model):
         self.minority_pc = minority_pc
         self.homophily = homophily
 
-        self.schedule = RandomActivation(self)
-        self.grid = SingleGrid(width, height, torus=True)
+        # numpy generator for the bulk initial layout (the seed also seeds self.random, see mesa's Model.__new__)
+        self.np_random = np.random.default_rng(seed)
 
         self.happy = 0
-        self.datacollector = DataCollector(
+        self.datacollector = make_datacollector(
             {
                 "happy": "happy",
                 "total_satisfaction_index": lambda m: self.total_satisfaction_index,
                 "blue_satisfaction_index": lambda m: self.blue_satisfaction_index,
                 "red_satisfaction_index": lambda m: self.red_satisfaction_index,
-                "segregated_Agents": get_segregation
-            }
+                "segregated_Agents": get_segregation,
+                **metric_reporters(metrics, metrics_interval)
+            },
+            history_window, history_file
         )
 
         # Set up agents
-        # We use a grid iterator that returns
-        # the coordinates of a cell as well as
-        # its contents. (coord_iter)
-        for cell in self.grid.coord_iter():
-            x = cell[1]
-            y = cell[2]
-            if self.random.random() < self.density:
-                if self.random.random() < self.minority_pc:
-                    agent_type = 1
-                    self.total_blue_agents_count += 1
-                else:
-                    agent_type = 0
-                    self.total_red_agents_count += 1
-                agent = SchellingAgent((x, y), self, agent_type)
-                self.grid.position_agent(agent, x, y)
-                self.schedule.add(agent)
+        # The initial layout is generated in bulk from the seeded numpy generator and stored as arrays,
+        # agent objects are only created as views when they are requested (e.g. by the visualisation)
+        layout = generate_layout(self.width, self.height, self.density, self.minority_pc, self.np_random)
+        self.store = AgentStore(layout)
+        self.schedule = HappinessSchedule(self, self.agent_step)
+        self.grid = ArrayGrid(self)
+
+        self.total_blue_agents_count = self.store.type_count(1)
+        self.total_red_agents_count = self.store.type_count(0)
 
         self.running = True
         self.datacollector.collect(self)
@@ -110,11 +71,15 @@ class Schelling(Model):
         """
         Run one step of the model. If All agents are happy, halt the model.
         """
-        self.happy = 0  # Reset counter of happy agents
-        self.happy_blue_agents_count = 0
-        self.happy_red_agents_count = 0
         self.schedule.step()
 
+        # The happiness counters follow from the number of agents that were unhappy at their turn
+        # (see HappinessSchedule, happy agents are not visited)
+        unhappy_red, unhappy_blue = self.schedule.unhappy_counts.tolist()
+        self.happy_blue_agents_count = self.total_blue_agents_count - unhappy_blue
+        self.happy_red_agents_count = self.total_red_agents_count - unhappy_red
+        self.happy = self.happy_blue_agents_count + self.happy_red_agents_count
+
         # calculates the blue and red satisfaction index
         self.blue_satisfaction_index = float(self.happy_blue_agents_count / max(self.total_blue_agents_count, 1))
         self.red_satisfaction_index = float(self.happy_red_agents_count / max(self.total_red_agents_count, 1))
@@ -130,18 +95,23 @@ class Schelling(Model):
         if self.happy == self.schedule.get_agent_count():
             self.running = False
 
+    def agent_step(self, agent_id):
+        """
+        Step of an unhappy agent (by id in the agent store): the agent relocates to a random empty cell.
+        The schedule only activates the agents that are unhappy at their turn.
+        """
+        self.store.move(agent_id, self.store.random_empty_cell(self.random))
+
+    def close(self):
+        """
+        Closes the files of the model (the history file), call it when the run is finished
+        """
+        if hasattr(self.datacollector, "close"):
+            self.datacollector.close()
+
 #For Datacollector
 def get_segregation(model):
     '''
     Find the % of agents that only have neighbors of their same type.
     '''
-    segregated_agents = 0
-    for agent in model.schedule.agents:
-        segregated = True
-        for neighbor in model.grid.neighbor_iter(agent.pos):
-            if neighbor.type != agent.type:
-                segregated = False
-                break
-        if segregated:
-            segregated_agents += 1
-    return segregated_agents / model.schedule.get_agent_count()
\ No newline at end of file
+    return model.store.count_segregated() / model.schedule.get_agent_count()
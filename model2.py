@@ -1,72 +1,25 @@
-from mesa import Model, Agent
-from mesa.time import RandomActivation
-from mesa.space import SingleGrid
-from mesa.datacollection import DataCollector
+from mesa import Model
+from collector import make_datacollector
 from random import random
-
-
-class SchellingAgent(Agent):
-    """
-    Schelling segregation agent
-    """
-
-    def __init__(self, pos, model, agent_type):
-        """
-        Create a new Schelling agent.
-
-        Args:
-           unique_id: Unique identifier for the agent.
-           x, y: Agent initial location.
-           agent_type: Indicator for the agent's type (minority=1 (blue), majority=0 (red))
-        """
-        super().__init__(pos, model)
-        self.pos = pos
-        self.type = agent_type
-
-    def step(self):
-        similar = 0
-        total_neighbors = 0
-        for neighbor in self.model.grid.iter_neighbors(self.pos, moore=True,
-                                                       radius=1):  # Adjust vision here to Moore (square neighborhood) and radius size
-            total_neighbors += 1
-            if neighbor.type == self.type:
-                similar += 1
-
-        # If unhappy, move to a location within their socioeconomic limits
-        if total_neighbors == 0 or ((similar / total_neighbors) < self.model.homophily):
-            if self.type == 1:
-                if len(self.model.potential_blue_cells) != 0:  # Agent will not move if there are no potential locations left
-                    new_location = self.model.random.choice(self.model.potential_blue_cells)
-                    self.model.grid.move_agent(self, new_location)
-                    self.model.movements += 1
-                    self.model.potential_blue_cells.remove(new_location)
-                    if new_location in self.model.potential_red_cells:  # Makes sure the new location is removed from both lists
-                        self.model.potential_red_cells.remove(new_location)
-            else:
-                if len(self.model.potential_red_cells) != 0:
-                    new_location = self.model.random.choice(self.model.potential_red_cells)
-                    self.model.grid.move_agent(self, new_location)
-                    self.model.movements += 1
-                    self.model.potential_red_cells.remove(new_location)
-                    if new_location in self.model.potential_blue_cells:
-                        self.model.potential_blue_cells.remove(new_location)
-
-
-        # Otherwise count agent as happy
-        else:
-            self.model.happy += 1
-            if self.type == 1:
-                self.model.happy_blue_agents_count += 1
-            else:
-                self.model.happy_red_agents_count += 1
+import numpy as np
+from metrics import metric_reporters
+from functions import EMPTY, sample_destination, generate_layout
+from agent_store import AgentStore, HappinessSchedule, ArrayGrid
+from eventlog import EventLog
 
 
 class Schelling(Model):
     """
     Model class for the Schelling segregation model.
+
+    The agents are stored as arrays in an AgentStore, self.schedule and self.grid are mesa-compatible views on it.
     """
 
-    def __init__(self, height=20, width=20, density=0.8, minority_pc=0.2, homophily=3):
+    def __init__(self, height=20, width=20, density=0.8, minority_pc=0.2, homophily=3, lazy_destinations=False, min_acceptance_rate=0.05, seed=None, metrics=(), metrics_interval=1, event_log=None, history_window=None, history_file=None):
+
+        # Constructor arguments, used to fork the model from a snapshot with changed parameters (see snapshot.py)
+        self.parameters = dict(locals())
+        del self.parameters["self"]
 
         self.total_satisfaction_index = 0
         self.blue_satisfaction_index = 0
@@ -85,8 +38,19 @@ class Schelling(Model):
         self.potential_blue_cells = []
         self.potential_red_cells = []
 
-        self.schedule = RandomActivation(self)
-        self.grid = SingleGrid(width, height, torus=True)
+        # Lazy destination search: unhappy agents sample random empty cells until one is a correct location instead of
+        # picking from lists that are built before anyone moves. When less than min_acceptance_rate of the sampled
+        # cells of a step is accepted, the model falls back to the lists for the rest of that step.
+        self.lazy_destinations = lazy_destinations
+        if not 0 < min_acceptance_rate <= 1:
+            raise ValueError("min_acceptance_rate must be larger than 0 and at most 1")
+        self.min_acceptance_rate = min_acceptance_rate
+        self.lazy_fallback = False
+        self.lazy_samples = 0
+        self.lazy_accepted = 0
+
+        # numpy generator for the bulk initial layout (the seed also seeds self.random, see mesa's Model.__new__)
+        self.np_random = np.random.default_rng(seed)
 
         #to count per step the amount of agents that have relocated
         self.movements = 0
@@ -96,34 +60,32 @@ class Schelling(Model):
         self.happy = 0
         self.happiness_reached = False
 
-        self.datacollector = DataCollector(
+        self.datacollector = make_datacollector(
             {
                 "happy": "happy",
                 "total_satisfaction_index": lambda m: self.total_satisfaction_index,
                 "blue_satisfaction_index": lambda m: self.blue_satisfaction_index,
                 "red_satisfaction_index": lambda m: self.red_satisfaction_index,
                 "segregated_Agents": get_segregation,
-                "happiness reached" : "happiness_reached"
-            }
+                "happiness reached" : "happiness_reached",
+                **metric_reporters(metrics, metrics_interval)
+            },
+            history_window, history_file
         )
 
         # Set up agents
-        # We use a grid iterator that returns
-        # the coordinates of a cell as well as
-        # its contents. (coord_iter)
-        for cell in self.grid.coord_iter():
-            x = cell[1][0]
-            y = cell[1][1]
-            if self.random.random() < self.density:
-                if self.random.random() < self.minority_pc:
-                    agent_type = 1
-                    self.total_blue_agents_count += 1
-                else:
-                    agent_type = 0
-                    self.total_red_agents_count += 1
-                agent = SchellingAgent((x, y), self, agent_type)
-                self.grid.place_agent(agent=agent, pos=(x, y))
-                self.schedule.add(agent)
+        # The initial layout is generated in bulk from the seeded numpy generator and stored as arrays,
+        # agent objects are only created as views when they are requested (e.g. by the visualisation)
+        layout = generate_layout(self.width, self.height, self.density, self.minority_pc, self.np_random)
+        self.store = AgentStore(layout)
+        self.schedule = HappinessSchedule(self, self.agent_step)
+        self.grid = ArrayGrid(self)
+
+        # Optional binary log of every relocation (see eventlog.py)
+        self.event_log = None if event_log is None else EventLog(event_log, width, height, self.store.count)
+
+        self.total_blue_agents_count = self.store.type_count(1)
+        self.total_red_agents_count = self.store.type_count(0)
 
         self.running = True
         self.datacollector.collect(self)
@@ -138,45 +100,30 @@ class Schelling(Model):
         if self.movements == 0 and self.schedule.time >0:
             self.running = False
 
-        # Creating the lists including the coordinates of potential locations that are
+        # Creating the lists including the cells of potential locations that are
         # within the socioeconomic limits of the blue (minority) and red (majority) agents
-        self.potential_blue_cells = []
-        self.potential_red_cells = []
-        for cell in self.grid.coord_iter():
-            x = cell[1][0]
-            y = cell[1][1]
-
-            if self.grid.is_cell_empty((x, y)):
-                list_neighbors = []
-                get_neighbors_list = self.grid.get_neighbors((x, y), moore=True, radius=1)
-
-                for neighbor in get_neighbors_list:
-                    if neighbor.type == 1:
-                        list_neighbors += [1]
-
-                    elif neighbor.type == 0:
-                        list_neighbors += [0]
-
-                # Defining what satisfies as homophily correct neighborhoods
-                if ((list_neighbors.count(0) + list_neighbors.count(1)) != 0) and (
-                (list_neighbors.count(1) / (list_neighbors.count(0) + list_neighbors.count(1)))) >= self.homophily:
-                    if (x, y) not in self.potential_blue_cells:
-                        self.potential_blue_cells.append((x, y))
-
-                if ((list_neighbors.count(0) + list_neighbors.count(1)) != 0) and (
-                (list_neighbors.count(0) / (list_neighbors.count(0) + list_neighbors.count(1)))) >= self.homophily:
-                    if (x, y) not in self.potential_red_cells:
-                        self.potential_red_cells.append((x, y))
+        # (in lazy mode the lists are only built when the model falls back to them)
+        self.lazy_fallback = False
+        self.lazy_samples = 0
+        self.lazy_accepted = 0
+        if not self.lazy_destinations:
+            self.build_potential_cells()
 
         #print(f'list of potential locations blues: {self.potential_blue_cells}')
         #print(f'list of potential locations reds: {self.potential_red_cells}')
 
 
-        self.happy = 0  # Reset counter of happy agents
-        self.happy_blue_agents_count = 0
-        self.happy_red_agents_count = 0
         self.movements = 0
         self.schedule.step()
+        if self.event_log is not None:
+            self.event_log.flush()
+
+        # The happiness counters follow from the number of agents that were unhappy at their turn
+        # (see HappinessSchedule, happy agents are not visited)
+        unhappy_red, unhappy_blue = self.schedule.unhappy_counts.tolist()
+        self.happy_blue_agents_count = self.total_blue_agents_count - unhappy_blue
+        self.happy_red_agents_count = self.total_red_agents_count - unhappy_red
+        self.happy = self.happy_blue_agents_count + self.happy_red_agents_count
 
         self.time = self.schedule.time
 
@@ -194,19 +141,89 @@ class Schelling(Model):
         # collect data
         self.datacollector.collect(self)
 
+    def agent_step(self, agent_id):
+        """
+        Step of an unhappy agent (by id in the agent store): the agent relocates to a potential location.
+        The schedule only activates the agents that are unhappy at their turn.
+        """
+        agent_type = int(self.store.types[agent_id])
+        new_location = self.choose_destination(agent_type)
+        if new_location is not None:        # Agent will not move if there are no potential locations left
+            old_location = self.store.move(agent_id, new_location)
+            if self.event_log is not None:
+                self.event_log.record(self.schedule.steps + 1, agent_id, old_location, new_location, agent_type)
+            self.movements += 1
+
+    def classify_cell(self, cell):
+        """
+        Checks whether the cell (flat index) is a homophily correct neighborhood for the blue and the red agents.
+        Returns a tuple (blue_correct, red_correct), occupied cells are never correct.
+        """
+        if self.store.grid[cell] != EMPTY:
+            return False, False
+
+        count_0 = int(self.store.counts[0, cell])
+        count_1 = int(self.store.counts[1, cell])
+        total_count = count_0 + count_1
+
+        # Defining what satisfies as homophily correct neighborhoods
+        blue_correct = total_count != 0 and (count_1 / total_count) >= self.homophily
+        red_correct = total_count != 0 and (count_0 / total_count) >= self.homophily
+
+        return blue_correct, red_correct
+
+    def build_potential_cells(self):
+        """
+        Classifies every empty cell of the grid and creates the lists of potential locations
+        """
+        self.potential_blue_cells = []
+        self.potential_red_cells = []
+        for cell in np.flatnonzero(self.store.grid == EMPTY).tolist():
+            blue_correct, red_correct = self.classify_cell(cell)
+            if blue_correct:
+                self.potential_blue_cells.append(cell)
+            if red_correct:
+                self.potential_red_cells.append(cell)
+
+    def choose_destination(self, agent_type):
+        """
+        Chooses a new location for an unhappy agent of the given type and makes sure it can not be chosen again.
+        Returns None when there is no potential location left.
+        """
+        if self.lazy_destinations and not self.lazy_fallback:
+            new_location = sample_destination(self, agent_type)
+            if new_location is not None:
+                return new_location
+            # Too few sampled cells are accepted, use the lists for the rest of this step
+            self.lazy_fallback = True
+            self.build_potential_cells()
+
+        if agent_type == 1:
+            potential_cells, other_cells = self.potential_blue_cells, self.potential_red_cells
+        else:
+            potential_cells, other_cells = self.potential_red_cells, self.potential_blue_cells
+
+        if len(potential_cells) == 0:
+            return None
+        new_location = self.random.choice(potential_cells)
+        potential_cells.remove(new_location)
+        if new_location in other_cells:     # Makes sure the new location is removed from both lists
+            other_cells.remove(new_location)
+        return new_location
+
+    def close(self):
+        """
+        Closes the files of the model (the event log and the history file), call it when the run is finished
+        """
+        if self.event_log is not None:
+            self.event_log.close()
+            self.event_log = None
+        if hasattr(self.datacollector, "close"):
+            self.datacollector.close()
 
 #Function that defines when an agent is segregated (for Datacollector)
 def get_segregation(model):
     '''
     Find the % of agents that only have neighbors of their same type.
     '''
-    segregated_agents = 0
-    for agent in model.schedule.agents:
-        segregated = True
-        for neighbor in model.grid.iter_neighbors(agent.pos, moore=True):
-            if neighbor.type != agent.type:
-                segregated = False
-                break
-        if segregated:
-            segregated_agents += 1
-    return segregated_agents / model.schedule.get_agent_count()
\ No newline at end of file
+    return model.store.count_segregated() / model.schedule.get_agent_count()
@@ -0,0 +1,207 @@
+from mesa import Model
+from collector import make_datacollector
+import numpy as np
+from metrics import metric_reporters
+from functions import EMPTY, generate_group_layout
+from agent_store import AgentStore, ArraySchedule, ArrayGrid
+
+
+class Schelling(Model):
+    """
+    Model class for the Schelling segregation model with any number of groups (K groups).
+
+    Generalisation of the rules of model2, model3a (with reference_group=1) and model3b. The whole population is
+    stored in an AgentStore: a single uint8 type array (group number per cell, EMPTY for empty cells) together with K
+    count planes (per cell the number of neighbors of each group), so happiness and the potential locations are
+    computed for all agents and cells at once. self.schedule and self.grid are mesa-compatible views on the store.
+    Unlike the other models, the happiness of all agents is determined at the start of a step, after which the
+    unhappy agents relocate in a random order.
+    """
+
+    def __init__(self, height=20, width=20, density=0.8, group_pcs=(0.5, 0.3, 0.2), homophily=0.3,
+                 socioeconomic_homophily=0, reference_group=None, seed=None, metrics=(), metrics_interval=1,
+                 history_window=None, history_file=None):
+        """
+        Create a new K-group Schelling model.
+
+        Args:
+            group_pcs: Fraction of the population per group, the number of groups K is the length of this sequence
+            homophily: The desired ratio of similar neighbors, one value for all groups or a sequence with one value
+                per group
+            socioeconomic_homophily: The ratio of similar neighbors needed to deem a cell a socio-economic "correct"
+                neighborhood, one value or one value per group. 0 gives the model2 rules, None for a group lets that
+                group move to every empty cell (like the reds in model3b)
+            reference_group: The group of which the share among the neighbors of an empty cell is compared to
+                homophily and socioeconomic_homophily to decide whether the cell is a correct location. None uses the
+                share of the own group (the model2 and model3b rules), a group number uses the share of that group for
+                every group (1 gives the model3a rules, in which the reds are also judged on the share of blues), or a
+                sequence with a group number or None per group
+            metrics: Names of extra segregation metrics to collect (see metrics.METRICS)
+            metrics_interval: The extra metrics are computed every metrics_interval steps
+            history_window: Only keep the last history_window steps of the model variables, plus running aggregates
+                (see collector.py). None keeps the full history
+            history_file: With a history_window, file to which the full history is written
+        """
+        # Constructor arguments, used to fork the model from a snapshot with changed parameters (see snapshot.py)
+        self.parameters = dict(locals())
+        del self.parameters["self"]
+
+        self.height = height
+        self.width = width
+        self.density = density
+        self.group_pcs = group_pcs
+        self.groups = len(group_pcs)
+
+        self.homophily = np.broadcast_to(np.asarray(homophily, dtype=float), (self.groups,))
+        if np.ndim(socioeconomic_homophily) == 0:
+            socioeconomic_homophily = [socioeconomic_homophily] * self.groups
+        self.unrestricted = np.array([value is None for value in socioeconomic_homophily])
+        self.socioeconomic_homophily = np.array([0 if value is None else value for value in socioeconomic_homophily],
+                                                dtype=float)
+        if np.ndim(reference_group) == 0:
+            reference_group = [reference_group] * self.groups
+        self.reference_group = np.array([group if reference is None else reference
+                                         for group, reference in enumerate(reference_group)], dtype=int)
+        if len(self.reference_group) != self.groups or not np.all((0 <= self.reference_group) &
+                                                                   (self.reference_group < self.groups)):
+            raise ValueError(f"reference_group must be a group number (0 to {self.groups - 1}) or None per group")
+
+        # numpy generator for the bulk initial layout (the seed also seeds self.random, see mesa's Model.__new__)
+        self.np_random = np.random.default_rng(seed)
+
+        # Population: group per cell (flat, in coord_iter order) and the number of neighbors of each group per cell
+        layout = generate_group_layout(width, height, density, group_pcs, self.np_random)
+        self.store = AgentStore(layout, self.groups)
+        self.schedule = ArraySchedule(self)
+        self.grid = ArrayGrid(self)
+
+        self.total_group_agents_count = np.bincount(self.store.types, minlength=self.groups)
+        self.happy_group_agents_count = np.zeros(self.groups, dtype=int)
+        self.total_satisfaction_index = 0
+        self.group_satisfaction_index = [0] * self.groups
+
+        # to count per step the amount of agents that have relocated
+        self.movements = 0
+
+        self.happy = 0
+        self.happiness_reached = False
+
+        self.datacollector = make_datacollector(
+            {
+                "happy": "happy",
+                "total_satisfaction_index": lambda m: self.total_satisfaction_index,
+                "group_satisfaction_index": lambda m: list(self.group_satisfaction_index),
+                "segregated_Agents": get_segregation,
+                "happiness reached": "happiness_reached",
+                **metric_reporters(metrics, metrics_interval)
+            },
+            history_window, history_file
+        )
+
+        self.running = True
+        self.datacollector.collect(self)
+
+        print("This is model K")
+
+    def store_restored(self):
+        """
+        Recomputes the counters that follow from the agents after the agents of the store were replaced (see
+        snapshot.fork_model), the happy counts follow from the restored satisfaction indices
+        """
+        self.total_group_agents_count = np.bincount(self.store.types, minlength=self.groups)
+        self.happy_group_agents_count = np.rint(np.asarray(self.group_satisfaction_index, dtype=float) *
+                                                np.maximum(self.total_group_agents_count, 1)).astype(int)
+
+    def happy_agents(self):
+        """
+        Returns for every agent (by id) whether it is happy with its neighborhood
+        """
+        store = self.store
+        similar = store.counts[store.types, store.cells]
+        total_neighbors = store.totals[store.cells].astype(int)
+
+        # An agent without neighbors is unhappy
+        return (total_neighbors != 0) & (similar / np.maximum(total_neighbors, 1) >= self.homophily[store.types])
+
+    def potential_cells(self):
+        """
+        Classifies every empty cell for every group at once.
+        Returns a list with per group the flat indices of the empty cells that are a correct location for that group
+        """
+        empty_cells = np.flatnonzero(self.store.grid == EMPTY)
+        counts = self.store.counts[:, empty_cells]
+        total_count = self.store.totals[empty_cells].astype(int)
+
+        # Per group the share of its reference group (its own group by default) among the neighbors
+        share = counts[self.reference_group] / np.maximum(total_count, 1)
+
+        # Defining what satisfies as socioeconomic correct neighborhoods (per group)
+        correct = (total_count != 0) & (share >= self.homophily[:, None]) & (
+                share >= self.socioeconomic_homophily[:, None])
+        correct |= self.unrestricted[:, None]
+        return [empty_cells[correct[group]] for group in range(self.groups)]
+
+    def step(self):
+        """
+        Run one step of the model. If All agents are happy, halt the model.
+        """
+        # Stop the model when everyone is not moving anymore due to happiness or due to lack of movement
+        if self.movements == 0 and self.schedule.time > 0:
+            self.running = False
+
+        happy = self.happy_agents()
+        agent_types = self.store.types
+        potential_cells = [cells.tolist() for cells in self.potential_cells()]
+        available = [len(cells) for cells in potential_cells]
+
+        # The unhappy agents relocate in a random order to a random potential location of their group. A chosen
+        # location is taken for all groups: it is skipped (and removed) when it is drawn again by another group.
+        taken = set()
+        moved_agents = []
+        new_cells = []
+        for agent_id in self.np_random.permutation(np.flatnonzero(~happy)).tolist():
+            group = agent_types[agent_id]
+            cells = potential_cells[group]
+            while available[group] > 0:
+                i = self.random.randrange(available[group])
+                new_location = cells[i]
+                available[group] -= 1
+                cells[i] = cells[available[group]]
+                if new_location not in taken:
+                    taken.add(new_location)
+                    moved_agents.append(agent_id)
+                    new_cells.append(new_location)
+                    break
+
+        self.movements = len(new_cells)
+        if self.movements > 0:
+            self.store.move_many(np.array(moved_agents), np.array(new_cells))
+
+        self.schedule.step()
+
+        # calculates the satisfaction index per group and in total
+        self.happy = int(np.count_nonzero(happy))
+        self.happy_group_agents_count = np.bincount(agent_types[happy], minlength=self.groups)
+        self.group_satisfaction_index = (self.happy_group_agents_count /
+                                         np.maximum(self.total_group_agents_count, 1)).tolist()
+        self.total_satisfaction_index = float(self.happy / max(self.store.count, 1))
+
+        if self.happy == self.store.count:
+            self.happiness_reached = True
+        # collect data
+        self.datacollector.collect(self)
+
+    def close(self):
+        """
+        Closes the files of the model (the history file), call it when the run is finished
+        """
+        if hasattr(self.datacollector, "close"):
+            self.datacollector.close()
+
+
+#Function that defines when an agent is segregated (for Datacollector)
+def get_segregation(model):
+    '''
+    Find the % of agents that only have neighbors of their same type.
+    '''
+    return model.store.count_segregated() / max(model.schedule.get_agent_count(), 1)
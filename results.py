@@ -0,0 +1,160 @@
+'''
+Results layer of the parameter sweeps (sweep.py), so the analysis does not have to load every step of every run.
+
+Next to the run table (one row per run, the output file of the sweep config) a sweep writes:
+
+- <output>.summary.<format>: one row per parameter combination with the mean and quantiles of every model variable
+  at the end of the runs and statistics of the number of steps until the runs stopped or reached full happiness
+- <output>.steps/combination=<c>/run-<RunId>.<format> (when "step_data" is true in the config): the model variables
+  of every step, partitioned per parameter combination so only the requested combinations and columns are read
+
+    results = SweepResults.from_config("sweeps/model2.json")
+    summary = results.summary()                                   # small, loads in no time
+    steps = results.steps(["happy"], homophily=0.3)               # only the partitions of homophily 0.3
+'''
+import os
+
+import numpy as np
+import pandas as pd
+
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+# Columns of the run table that are not model variables
+RUN_COLUMNS = ("RunId", "iteration", "Combination", "seed")
+
+# Statistics of the number of steps per run
+CONVERGENCE_COLUMNS = ("Step", "happiness_step")
+
+
+def summary_path(output):
+    root, ext = os.path.splitext(output)
+    return f"{root}.summary{ext}"
+
+
+def steps_directory(output):
+    return os.path.splitext(output)[0] + ".steps"
+
+
+def partition_path(output, combination, run_id, output_format):
+    '''File with the step data of one run'''
+    return os.path.join(steps_directory(output), f"combination={combination}", f"run-{run_id}.{output_format}")
+
+
+def write_table(data, path, output_format):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if output_format == "parquet":
+        data.to_parquet(path, index=False)
+    else:
+        data.to_csv(path, index=False)
+
+
+def read_table(path, output_format, columns=None):
+    '''Reads a table, only the given columns (all columns when None)'''
+    if output_format == "parquet":
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns, float_precision="round_trip")
+
+
+def happiness_step(datacollector):
+    '''
+    First step at which all agents were happy, NaN when that did not happen (or the model does not report it).
+    A RollingDataCollector only keeps the last steps: their step numbers start after the steps that were dropped, and
+    when happiness was already reached before the kept steps the first step follows from the running aggregates
+    ("happiness reached" stays True once it is reached, so it was True at the last mean * count steps).
+    '''
+    reached = datacollector.model_vars.get("happiness reached")
+    if reached is None or not any(reached):
+        return np.nan
+    collected = getattr(datacollector, "collected", len(reached))
+    first_step = collected - len(reached)
+    if first_step > 0 and reached[0]:
+        aggregate = datacollector.aggregates["happiness reached"]
+        return collected - round(aggregate["mean"] * aggregate["count"])
+    return first_step + list(reached).index(True)
+
+
+def summarize(runs, parameters):
+    '''
+    Summary per parameter combination: the swept and fixed parameters, the number of runs, and for every numeric
+    model variable and for the convergence steps the mean and the quantiles over the runs
+    '''
+    statistics = [column for column in runs.columns
+                  if column not in RUN_COLUMNS and column not in parameters and pd.api.types.is_numeric_dtype(runs[column])]
+    runs = runs.astype({column: float for column in statistics if pd.api.types.is_bool_dtype(runs[column])})
+
+    groups = runs.groupby("Combination", sort=True)
+    summary = groups[list(parameters)].first()
+    summary["runs"] = groups.size()
+    for column in statistics:
+        values = groups[column]
+        summary[f"{column}_mean"] = values.mean()
+        for quantile in QUANTILES:
+            summary[f"{column}_q{round(quantile * 100):02d}"] = values.quantile(quantile)
+        if column in CONVERGENCE_COLUMNS:
+            summary[f"{column}_max"] = values.max()
+    return summary.reset_index()
+
+
+class SweepResults:
+    '''
+    Lazy access to the results of a sweep. Nothing is read until a table is requested, and then only the requested
+    columns and (for the step data) the partitions of the requested parameter values.
+    '''
+
+    def __init__(self, output, output_format="csv"):
+        self.output = output
+        self.format = output_format
+
+    @classmethod
+    def from_config(cls, path):
+        from sweep import load_config
+        config = load_config(path)
+        return cls(config["output"], config["format"])
+
+    def summary(self, columns=None):
+        '''Summary table per parameter combination'''
+        return read_table(summary_path(self.output), self.format, columns)
+
+    def runs(self, columns=None):
+        '''Run table (model variables at the end of every run)'''
+        return read_table(self.output, self.format, columns)
+
+    def combinations(self, **parameters):
+        '''Combination numbers of which the parameters have the given values'''
+        summary = self.summary(["Combination", *parameters])
+        selected = np.ones(len(summary), dtype=bool)
+        for name, value in parameters.items():
+            selected &= np.isclose(summary[name], value) if isinstance(value, float) else summary[name] == value
+        return summary["Combination"][selected].tolist()
+
+    def steps(self, columns=None, **parameters):
+        '''
+        Step data of the runs with the given parameter values (all runs without parameters), only the given columns
+        (plus RunId and Step). Only the partitions of the matching parameter combinations are read.
+        '''
+        if columns is not None:
+            columns = ["RunId", "Step", *[column for column in columns if column not in ("RunId", "Step")]]
+
+        directory = steps_directory(self.output)
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f"No step data in {directory}, run the sweep with \"step_data\": true in its config")
+        if parameters:
+            partitions = [f"combination={combination}" for combination in self.combinations(**parameters)]
+        else:
+            partitions = sorted(os.listdir(directory))
+
+        tables = []
+        for partition in partitions:
+            combination = int(partition.split("=")[1])
+            partition_directory = os.path.join(directory, partition)
+            if not os.path.isdir(partition_directory):
+                continue    # no runs of this combination (e.g. a shard that was not run here)
+            for name in sorted(os.listdir(partition_directory)):
+                table = read_table(os.path.join(partition_directory, name), self.format, columns)
+                table.insert(0, "Combination", combination)
+                tables.append(table)
+        if not tables:
+            return pd.DataFrame(columns=["Combination", *(columns or [])])
+        return pd.concat(tables, ignore_index=True)
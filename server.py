@@ -59,6 +59,10 @@ def schelling_draw(agent):
 map_height = 30
 map_width = 30
 
+# The charts only show the latest values, so the model only keeps the last steps of its data (memory stays flat
+# when the model keeps running, see collector.py)
+history_window = 100
+
 happy_element = HappyElement()
 agent_number_element = Agent_NumberElement()
 index_element = IndexElement()
@@ -80,6 +84,7 @@ model_params1_2 = {
         "Fraction minority", 0.3, 0.00, 1.0, 0.01
     ),
     "homophily": Slider("slider", "Homophily", 0.4, 0, 1, 0.05),
+    "history_window": history_window,
 }
 
 model_params3a = {
@@ -91,7 +96,8 @@ model_params3a = {
     ),
     "homophily": Slider("Homophily", 0.4, 0, 1, 0.05),
     "socioeconomic_homophily_reds": Slider("Socioeconomic homophily reds", 0.3, 0, 1, 0.05),
-    "socioeconomic_homophily_blues": Slider("Socioeconomic homophily blues", 0.5, 0, 1, 0.05)
+    "socioeconomic_homophily_blues": Slider("Socioeconomic homophily blues", 0.5, 0, 1, 0.05),
+    "history_window": history_window,
 }
 
 model_params3b = {
@@ -101,7 +107,8 @@ model_params3b = {
     "minority_pc": Slider("Fraction minority", 0.3, 0.00, 1.0, 0.01
     ),
     "homophily": Slider("Homophily", 0.4, 0, 1, 0.05),
-    "socioeconomic_homophily_blues": Slider("Socioeconomic homophily blues", 0.5, 0, 1, 0.05)
+    "socioeconomic_homophily_blues": Slider("Socioeconomic homophily blues", 0.5, 0, 1, 0.05),
+    "history_window": history_window,
 }
 
 #Change model params to the respective model (see above)
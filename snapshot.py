@@ -0,0 +1,191 @@
+'''
+Snapshots of the full state of a model between two steps (agent positions, counters, collected data and the state of
+the random generators), to fork many runs from the same burn-in instead of simulating it again for every run.
+
+    model = Schelling(height=100, width=100, homophily=0.3, seed=0)
+    for i in range(50):
+        model.step()
+    save_snapshot(snapshot(model), "results/burn_in.snapshot")
+
+    state = load_snapshot("results/burn_in.snapshot")
+    forks = [fork_model(state, homophily=homophily) for homophily in (0.3, 0.4, 0.5)]
+
+A fork without a seed continues with the same random numbers as the original model, so a fork without changes
+continues exactly like the original. With a seed the random generators of the fork are seeded again, to get different
+continuations of the same state. The parameters that define the initial layout can not be changed in a fork.
+
+Snapshots are pickled, only load snapshots from a trusted source.
+'''
+import copy
+import gzip
+import importlib
+import pickle
+
+import numpy as np
+from collector import RollingDataCollector, new_aggregate
+from eventlog import EventLog
+
+# Parameters that define the initial layout, these can not be changed in a fork
+LAYOUT_PARAMETERS = ("height", "width", "density", "minority_pc", "group_pcs")
+
+# Parameters that are not passed on to a fork unless they are given again (a fork must not overwrite the files of
+# the original model)
+NOT_INHERITED = ("event_log", "history_file")
+
+# Attributes that are rebuilt by the model from the parameters and the agent positions instead of being stored
+REBUILT_ATTRIBUTES = ("potential_blue_cells", "potential_red_cells", "dirty_cells")
+
+PLAIN_TYPES = (bool, int, float, str, type(None), np.generic)
+
+# Model variable that stays True once all agents were happy, it starts again in a fork with changed parameters
+HAPPINESS_REACHED = "happiness reached"
+
+
+def is_plain(value):
+    '''Whether an attribute is a plain value (counter, index, flag) or a list of plain values'''
+    if isinstance(value, list):
+        return all(isinstance(item, PLAIN_TYPES) for item in value)
+    return isinstance(value, PLAIN_TYPES)
+
+
+def same_value(a, b):
+    '''Compares parameter values, also sequences (e.g. group_pcs as a tuple or a list)'''
+    try:
+        return bool(np.array_equal(np.asarray(a, dtype=object), np.asarray(b, dtype=object)))
+    except ValueError:
+        return a == b
+
+
+def snapshot(model):
+    '''Full state of a model (between two steps) as a dict of plain values and numpy arrays'''
+    store = model.store
+    counters = {name: value for name, value in vars(model).items()
+                if name not in model.parameters and name not in REBUILT_ATTRIBUTES and is_plain(value)}
+    return {
+        "model": type(model).__module__,
+        "parameters": copy.deepcopy(model.parameters),
+        "grid": store.grid.copy(),
+        "cells": store.cells.astype(np.uint32 if store.grid.size < 2 ** 32 else np.uint64),
+        "counters": copy.deepcopy(counters),
+        "steps": model.schedule.steps,
+        "time": model.schedule.time,
+        "model_vars": {name: list(values) for name, values in copy.deepcopy(model.datacollector.model_vars).items()},
+        "aggregates": copy.deepcopy(getattr(model.datacollector, "aggregates", None)),
+        "collected": getattr(model.datacollector, "collected", None),
+        "random": model.random.getstate(),
+        "np_random": model.np_random.bit_generator.state,
+    }
+
+
+def cleared_aggregate(count):
+    '''Running aggregates of a variable that was False at count steps'''
+    aggregate = new_aggregate()
+    if count:
+        aggregate.update(count=count, min=0.0, max=0.0, last=0.0, change=0.0 if count > 1 else None)
+    return aggregate
+
+
+def save_snapshot(state, path):
+    '''Writes a snapshot to a (gzip compressed) file'''
+    with gzip.open(path, "wb") as file:
+        pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_snapshot(path):
+    with gzip.open(path, "rb") as file:
+        return pickle.load(file)
+
+
+def fork_model(state, seed=None, **changes):
+    '''
+    Creates a model from a snapshot, with the given parameters changed.
+    Without a seed the fork continues with the random numbers of the snapshot, with a seed the random generators are
+    seeded again. When parameters are changed the stop condition and happiness reached start again, as for a new
+    model: happiness reached is False for the steps before the fork.
+    A snapshot that only has the last steps of its model variables (history_window) can only be forked with a
+    history_window, the steps of the full history are not known.
+    '''
+    parameters = dict(state["parameters"])
+    for name in NOT_INHERITED:
+        if name in parameters:
+            parameters[name] = None
+    changed = []
+    for name, value in changes.items():
+        if name not in parameters:
+            raise ValueError(f"Unknown parameter '{name}' of {state['model']}")
+        if not same_value(value, parameters[name]):
+            if name in LAYOUT_PARAMETERS:
+                raise ValueError(f"Parameter '{name}' defines the layout and can not be changed in a fork")
+            changed.append(name)
+    parameters.update(changes)
+    if seed is not None:
+        parameters["seed"] = seed
+    kept = len(next(iter(state["model_vars"].values()), []))
+    if parameters.get("history_window") is None and (state.get("collected") or 0) > kept:
+        raise ValueError("The snapshot only has the last steps of the model variables, fork it with a history_window")
+
+    # The model is created with the (changed) parameters, so everything that is derived from them is set up by the
+    # model itself, after which the agents and counters of the snapshot replace the new ones. The event log is
+    # opened afterwards, its header has the number of agents of the snapshot.
+    event_log = parameters.get("event_log")
+    Schelling = importlib.import_module(state["model"]).Schelling
+    model = Schelling(**dict(parameters, event_log=None) if event_log is not None else parameters)
+    model.store.restore(state["grid"], state["cells"])
+    if hasattr(model.schedule, "reset"):
+        model.schedule.reset()
+    if event_log is not None:
+        model.parameters["event_log"] = event_log
+        model.event_log = EventLog(event_log, model.width, model.height, model.store.count)
+    for name, value in copy.deepcopy(state["counters"]).items():
+        setattr(model, name, value)
+    # Counters that are not plain values (e.g. the arrays of counts per group of modelk) are recomputed from the
+    # restored agents by the model, they must not come from the new layout of the fork
+    if hasattr(model, "store_restored"):
+        model.store_restored()
+    model.schedule.steps = state["steps"]
+    model.schedule.time = state["time"]
+
+    # Collected data of the snapshot, metrics that were not collected before the fork are None for those steps.
+    # The values are put in the existing containers, so a fork with a history_window keeps only that many values.
+    model_vars = copy.deepcopy(state["model_vars"])
+    collected = len(next(iter(model_vars.values()), []))
+    if changed and HAPPINESS_REACHED in model_vars:
+        # Happiness was reached under the parameters of the snapshot, under the new parameters it was not yet
+        model_vars[HAPPINESS_REACHED] = [False] * len(model_vars[HAPPINESS_REACHED])
+    for name, values in model.datacollector.model_vars.items():
+        values.clear()
+        values.extend(model_vars.get(name, [None] * collected))
+    if hasattr(model.datacollector, "aggregates"):
+        if state.get("aggregates") is not None:
+            # The running aggregates of the snapshot continue
+            for name, aggregate in copy.deepcopy(state["aggregates"]).items():
+                if name in model.datacollector.aggregates:
+                    if changed and name == HAPPINESS_REACHED:
+                        aggregate = cleared_aggregate(aggregate["count"])
+                    model.datacollector.aggregates[name] = aggregate
+            model.datacollector.collected = state["collected"]
+        else:
+            # The snapshot has the full history, the running aggregates are computed from it
+            for name in model.datacollector.aggregates:
+                aggregate = new_aggregate()
+                for value in model_vars.get(name, []):
+                    RollingDataCollector.update_aggregate(aggregate, value)
+                model.datacollector.aggregates[name] = aggregate
+            model.datacollector.collected = collected
+
+    if seed is None:
+        model.random.setstate(state["random"])
+        model.np_random.bit_generator.state = state["np_random"]
+    else:
+        model._seed = seed
+        model.random.seed(seed)
+        model.np_random = np.random.default_rng(seed)
+
+    if changed:
+        # Nobody moved under the new parameters yet, so the model does not stop because of the previous step
+        model.running = True
+        if hasattr(model, "movements"):
+            model.movements = None
+        if hasattr(model, "happiness_reached"):
+            model.happiness_reached = False
+    return model
@@ -0,0 +1,230 @@
+'''
+Command-line parameter sweep over any of the models, as an alternative to editing batch_run.py.
+
+    python sweep.py run sweeps/model2.json                  # the whole sweep on this machine
+    python sweep.py run sweeps/model2.json --shard 0/4      # only the first of 4 shards (e.g. one per machine)
+    python sweep.py merge sweeps/model2.json --shards 4     # combine the outputs of the 4 shards
+
+The config file (JSON) lists the model and the sweep settings:
+
+    {
+        "model": "model2",                      module of the Schelling class (model1, model2, model3a, model3b, modelk)
+        "parameters": {"height": 20, "density": [0.4, 0.8], ...},
+                                                single values are fixed, lists are swept (like mesa's batch_run,
+                                                wrap list-valued parameters such as metrics in another list)
+        "iterations": 100,                      runs per parameter combination
+        "max_steps": 200,                       maximum number of steps per run
+        "workers": 4,                           number of processes (default: all cpus)
+        "seed": 0,                              optional, run i gets seed + i so runs can be reproduced
+        "output": "results/model2_data.csv",    output file, shards write <name>.shard-<i>-of-<n>.<format>
+        "format": "csv",                        csv or parquet (needs pyarrow)
+        "step_data": false,                     also write the model variables of every step (see results.py)
+        "snapshot": "results/burn_in.snapshot"  optional, fork every run from this snapshot (see snapshot.py) instead
+                                                of starting from a new layout, max_steps includes the steps before it
+    }
+
+Besides the output file (one row per run) a complete sweep, or a merge, writes a summary table per parameter combination
+(see results.py for reading the results back).
+
+Model parameters that are files (event_log, history_file) are written per run, as <name>.run-<RunId>.<ext>.
+
+Every run gets a RunId from a fixed enumeration of all runs, shard i of n runs the runs with RunId % n == i, so the
+shards together cover the sweep exactly once, independent of the machine or the number of workers.
+'''
+import argparse
+import importlib
+import json
+import os
+from functools import lru_cache, partial
+from itertools import product
+from multiprocessing import Pool
+
+import pandas as pd
+
+from results import happiness_step, partition_path, read_table, summarize, summary_path, write_table
+from snapshot import fork_model, load_snapshot
+
+FORMATS = ("csv", "parquet")
+
+# Model parameters that are files, every run writes its own file (see run_path)
+FILE_PARAMETERS = ("event_log", "history_file")
+
+
+def load_config(path):
+    '''Reads a sweep config file and fills in the defaults'''
+    with open(path) as file:
+        return apply_defaults(json.load(file))
+
+
+def apply_defaults(config):
+    '''Fills in the defaults of a sweep config (dict) and checks the output format'''
+    config.setdefault("iterations", 1)
+    config.setdefault("max_steps", 1000)
+    config.setdefault("workers", None)
+    config.setdefault("seed", None)
+    config.setdefault("format", "csv")
+    config.setdefault("step_data", False)
+    config.setdefault("snapshot", None)
+    config.setdefault("output", os.path.join("results", config["model"] + "_data." + config["format"]))
+    if config["format"] not in FORMATS:
+        raise ValueError(f"Unknown output format '{config['format']}', choose from {', '.join(FORMATS)}")
+    return config
+
+
+def parameter_combinations(parameters):
+    '''All combinations of the parameter values (lists are swept, other values are fixed), in a fixed order'''
+    names = list(parameters)
+    values = [value if isinstance(value, list) else [value] for value in parameters.values()]
+    return [dict(zip(names, combination)) for combination in product(*values)]
+
+
+def enumerate_runs(config):
+    '''
+    List of (RunId, iteration, combination, kwargs) of all runs of the sweep, in the same order as mesa's batch_run.
+    combination is the number of the parameter combination.
+    '''
+    combinations = parameter_combinations(config["parameters"])
+    runs = [(iteration, combination, kwargs) for iteration in range(config["iterations"])
+            for combination, kwargs in enumerate(combinations)]
+    return [(run_id, *run) for run_id, run in enumerate(runs)]
+
+
+def parse_shard(text):
+    '''Parses "i/n" into (i, n)'''
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard must be given as i/n, got '{text}'")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index must be between 0 and {count - 1}, got {index}")
+    return index, count
+
+
+def shard_runs(runs, shard):
+    '''The runs of one shard (i, n): every n-th run starting at run i'''
+    index, count = shard
+    return [run for run in runs if run[0] % count == index]
+
+
+def shard_path(output, shard):
+    '''Output file of a shard: <name>.shard-<i>-of-<n>.<ext>'''
+    root, ext = os.path.splitext(output)
+    return f"{root}.shard-{shard[0]}-of-{shard[1]}{ext}"
+
+
+def run_path(path, run_id):
+    '''File of one run for a file parameter (e.g. an event_log): <name>.run-<RunId>.<ext>'''
+    root, ext = os.path.splitext(path)
+    return f"{root}.run-{run_id}{ext}"
+
+
+@lru_cache(maxsize=1)
+def cached_snapshot(path):
+    '''Loads a snapshot once per worker process'''
+    return load_snapshot(path)
+
+
+def run_model(run, model, max_steps, seed, step_output=None, output_format="csv", progress=None, progress_interval=1,
+              snapshot=None):
+    '''
+    Runs one model until it stops or reaches max_steps (like mesa's batch_run).
+    Returns the row with the run information, the parameters and the model variables of the last step.
+    With a step_output the model variables of every step are written to the partition of the run.
+    With a progress queue the RunId, step and model variables are put on it every progress_interval steps.
+    With a snapshot (path) the model is forked from the snapshot with the parameters of the run.
+    The file parameters (event_log, history_file) get the RunId in their name, so the runs do not write to the same file.
+    '''
+    run_id, iteration, combination, kwargs = run
+    Schelling = importlib.import_module(model).Schelling
+    if seed is not None:
+        kwargs = dict(kwargs, seed=seed + run_id)
+    kwargs = {name: run_path(value, run_id) if name in FILE_PARAMETERS and value is not None else value
+              for name, value in kwargs.items()}
+
+    if snapshot is None:
+        simulation = Schelling(**kwargs)
+    else:
+        simulation = fork_model(cached_snapshot(snapshot), **kwargs)
+    try:
+        while simulation.running and simulation.schedule.steps <= max_steps:
+            simulation.step()
+            if progress is not None and simulation.schedule.steps % progress_interval == 0:
+                model_vars = simulation.datacollector.model_vars
+                progress.put({"RunId": run_id, "Step": simulation.schedule.steps,
+                              **{name: values[-1] for name, values in model_vars.items()}})
+    finally:
+        simulation.close()
+
+    datacollector = simulation.datacollector
+    model_vars = datacollector.model_vars
+    if step_output is not None:
+        # Indexed by step, also when a history_window only kept the last steps
+        steps = datacollector.get_model_vars_dataframe()
+        steps.insert(0, "Step", steps.index)
+        steps.insert(0, "RunId", run_id)
+        write_table(steps, partition_path(step_output, combination, run_id, output_format), output_format)
+
+    last_step = {name: values[-1] for name, values in model_vars.items()}
+    return {"RunId": run_id, "iteration": iteration, "Combination": combination, "Step": simulation.schedule.steps,
+            "happiness_step": happiness_step(datacollector), **kwargs, **last_step}
+
+
+def run_sweep(config, shard=None):
+    '''Runs the (shard of the) sweep with a pool of worker processes and returns the results as a DataFrame'''
+    runs = enumerate_runs(config)
+    if shard is not None:
+        runs = shard_runs(runs, shard)
+
+    run = partial(run_model, model=config["model"], max_steps=config["max_steps"], seed=config["seed"],
+                  step_output=config["output"] if config["step_data"] else None, output_format=config["format"],
+                  snapshot=config["snapshot"])
+    with Pool(config["workers"]) as pool:
+        rows = pool.map(run, runs)
+    return pd.DataFrame(rows)
+
+
+def merge_shards(config, count):
+    '''Combines the outputs of all count shards into the output file of the config'''
+    paths = [shard_path(config["output"], (index, count)) for index in range(count)]
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"Missing shard output: {', '.join(missing)}")
+
+    data = pd.concat([read_table(path, config["format"]) for path in paths], ignore_index=True)
+    return data.sort_values("RunId", ignore_index=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parameter sweep over the Schelling models")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the sweep (or one shard of it)")
+    run_parser.add_argument("config", help="sweep config file (JSON)")
+    run_parser.add_argument("--shard", type=parse_shard, help="only run shard i of n, given as i/n")
+
+    merge_parser = commands.add_parser("merge", help="combine the outputs of the shards")
+    merge_parser.add_argument("config", help="sweep config file (JSON)")
+    merge_parser.add_argument("--shards", type=int, required=True, help="number of shards n")
+
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+
+    if args.command == "run":
+        data = run_sweep(config, args.shard)
+        path = config["output"] if args.shard is None else shard_path(config["output"], args.shard)
+    else:
+        data = merge_shards(config, args.shards)
+        path = config["output"]
+
+    write_table(data, path, config["format"])
+    print(f"Wrote {len(data)} runs to {path}")
+
+    # The summary needs all runs, so it is only written for a complete sweep
+    if args.command == "merge" or args.shard is None:
+        summary = summarize(data, config["parameters"])
+        write_table(summary, summary_path(config["output"]), config["format"])
+        print(f"Wrote the summary of {len(summary)} parameter combinations to {summary_path(config['output'])}")
+
+
+if __name__ == "__main__":
+    main()